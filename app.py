@@ -2,16 +2,18 @@ import json
 import os.path
 import re
 import shutil
-import time
 from datetime import datetime
-from pathlib import Path
 
 import gradio as gr
 
 from gpuhunter.autodl_client import FailedError, autodl_client
 from gpuhunter.data_object import RegionList, Config
+from gpuhunter.gpu_history import get_gpu_history
+from gpuhunter.hunt_supervisor import hunt_supervisor
+from gpuhunter.utils.events import hunt_events
 from gpuhunter.utils.helpers import json_dumps, validate_email
-from main import LOGS_DIR, logger, DATA_DIR
+from gpuhunter.utils.log_tail import LogTail
+from main import LOGS_DIR
 
 css = """
 .block.error-message, .block.success-message { padding: var(--block-padding); }
@@ -140,7 +142,10 @@ with gr.Blocks(title="AutoDL GPU Hunter", theme=gr.themes.Default(text_size="lg"
         gr_hunting_start_button = gr.Button("🙈 开始蹲守", variant="primary", size="lg")
         gr_hunting_error = gr.Markdown(elem_classes=["error-message"], visible=False)
         gr_hunting_stop_button = gr.Button("🤚 停止", variant="stop", size="lg", visible=False)
+        gr_hunting_status = gr.Markdown(visible=False)
         gr_hunting_logs = gr.Textbox(label="🙉 正在蹲守", autoscroll=True, lines=10, visible=False)
+        # 每个会话各自记录日志读到的位置
+        gr_hunting_logs_tail = gr.State(None)
 
 
         def load_region_options(gpu_type_names=None):
@@ -382,6 +387,10 @@ with gr.Blocks(title="AutoDL GPU Hunter", theme=gr.themes.Default(text_size="lg"
                           email_notify_smtp_password, email_notify_smtp_server, scan_interval,
                           shutdown_hunter_after_success):
             error_messages = []
+            if hunt_supervisor.is_running:
+                error_messages.append("已经在蹲守中，请先停止")
+            elif hunt_supervisor.is_stopping:
+                error_messages.append("上一次蹲守正在停止，请等待当前这轮扫描结束后再开始")
             if not gpu_types:
                 error_messages.append("请选择显卡型号")
             if not regions:
@@ -462,69 +471,121 @@ with gr.Blocks(title="AutoDL GPU Hunter", theme=gr.themes.Default(text_size="lg"
                 # 保存设置
                 config.save()
 
-                outputs = {
-                    gr_hunting_start_button: gr.Button(visible=False),
-                    gr_hunting_error: gr.Markdown(visible=False),
-                    gr_hunting_stop_button: gr.Button(visible=True),
-                    gr_hunting_logs: gr.Textbox(visible=True),
-                }
-                yield outputs
-                # 创建运行状态标记
-                Path(os.path.join(DATA_DIR, "running.state")).touch()
                 # 重新开启输出日志
                 output_log_file = os.path.join(LOGS_DIR, "output.log")
                 shutil.copy(output_log_file, f'{output_log_file}.{datetime.now().strftime("%Y-%m-%d_%H:%M:%S_%f")}')
                 with open(output_log_file, "w") as f:
                     f.truncate()
                     f.close()
-                while True:
-                    from gpuhunter.commands.wait import try_to_create_instances
-                    if not try_to_create_instances():
-                        # 否则等待指定时间后重试
-                        logger.info(
-                            f"等待 {config.retry_interval_seconds!r} 秒后重新扫描..."
-                            f" Next scanning will start after {config.retry_interval_seconds!r} seconds..."
-                        )
-                        yield outputs
-                        time.sleep(config.retry_interval_seconds)
-                    else:
-                        break
-                yield outputs
-            else:
-                yield {
-                    gr_hunting_start_button: gr.Button(visible=True),
-                    gr_hunting_error: gr.Markdown(visible=True, value="\n".join([f"- {m}" for m in error_messages])),
-                    gr_hunting_stop_button: gr.Button(visible=False),
-                    gr_hunting_logs: gr.Textbox(visible=False),
-                }
+                # 在后台线程中蹲守，不占用当前的请求；同时从其他页面开始的蹲守会让这里返回 False
+                if hunt_supervisor.start():
+                    return {
+                        gr_hunting_start_button: gr.Button(visible=False),
+                        gr_hunting_error: gr.Markdown(visible=False),
+                        gr_hunting_stop_button: gr.Button(visible=True),
+                        gr_hunting_logs: gr.Textbox(visible=True),
+                    }
+                error_messages.append("已经在蹲守中，请先停止")
+
+            return {
+                gr_hunting_start_button: gr.Button(visible=True),
+                gr_hunting_error: gr.Markdown(visible=True, value="\n".join([f"- {m}" for m in error_messages])),
+                gr_hunting_stop_button: gr.Button(visible=False),
+                gr_hunting_logs: gr.Textbox(visible=False),
+            }
 
 
         def hunting_stop():
-            # 重置运行标记
-            Path(os.path.join(DATA_DIR, "running.state")).unlink(missing_ok=True)
+            hunt_supervisor.stop()
+            is_stopping = hunt_supervisor.is_stopping
             return {
-                gr_hunting_start_button: gr.Button(visible=True),
+                gr_hunting_start_button: gr.Button(visible=not is_stopping),
                 gr_hunting_error: gr.Markdown(visible=False, value=""),
                 gr_hunting_stop_button: gr.Button(visible=False),
-                gr_hunting_logs: gr.Textbox(visible=False),
+                gr_hunting_logs: gr.Textbox(visible=is_stopping),
             }
 
 
-        def read_output_logs():
-            output_log_file = os.path.join(LOGS_DIR, "output.log")
-            if os.path.exists(output_log_file):
-                with open(output_log_file, "r") as f:
-                    return f.read()
+        def read_output_logs(log_tail):
+            if log_tail is None:
+                log_tail = LogTail(os.path.join(LOGS_DIR, "output.log"))
+            # 没有新日志时不更新文本框，避免每秒重新发送全部日志
+            if log_tail.update():
+                return log_tail.text, log_tail
             else:
-                return ""
+                return gr.Textbox(), log_tail
+
+
+        # 最近一次渲染的蹲守状态，多个页面共用：(版本, Markdown)
+        hunting_status_cache = [None, ""]
+
+
+        def render_hunting_status(version, state):
+            if hunting_status_cache[0] == version:
+                return hunting_status_cache[1]
+            lines = []
+            if state.get("stopping"):
+                lines.append("**状态**：正在停止，等待当前这轮扫描结束...")
+            elif state.get("finished"):
+                lines.append("**状态**：已完成")
+            elif state.get("scanning"):
+                lines.append("**状态**：正在扫描...")
+            elif next_scan_at := state.get("next_scan_at"):
+                lines.append(f'**状态**：等待下次扫描 ({datetime.fromtimestamp(next_scan_at).strftime("%H:%M:%S")}，'
+                             f'{state.get("next_scan_reason", "")})')
+            if last_scan_at := state.get("last_scan_at"):
+                line = (f'**上次扫描**：{datetime.fromtimestamp(last_scan_at).strftime("%H:%M:%S")}，'
+                        f'用时 {state.get("last_scan_seconds", 0):.1f} 秒')
+                if state.get("last_scan_error"):
+                    line += f'，出错：{state["last_scan_error"]}'
+                lines.append(line)
+            idle_gpus = [
+                f"{region_name} {gpu_type} × {idle_gpu_num}"
+                for region_name, gpu_types in (state.get("idle_gpus") or {}).items()
+                for gpu_type, idle_gpu_num in gpu_types.items()
+                if idle_gpu_num > 0
+            ]
+            if idle_gpus:
+                lines.append(f'**空闲 GPU**：{"，".join(idle_gpus[:10])}{" 等" if len(idle_gpus) > 10 else ""}')
+            counts = state.get("counts", {})
+            lines.append(f'**符合要求的机器**：{state.get("machines_matched", 0)}'
+                         f' ｜ **已创建实例**：{counts.get("instance_created", 0)}'
+                         f' ｜ **创建失败**：{counts.get("instance_create_failed", 0)}')
+            hunting_status_cache[:] = [version, "\n\n".join(lines)]
+            return hunting_status_cache[1]
+
+
+        async def stream_hunting_status():
+            """
+            订阅蹲守事件，只在状态变化时更新页面。异步等待，打开的页面不会各自占用一个工作线程。
+            """
+            version, last_outputs = -1, None
+            while True:
+                version, state = await hunt_events.wait_async(version, timeout=30)
+                is_hunting = bool(state.get("running"))
+                is_stopping = bool(state.get("stopping"))
+                is_visible = is_hunting or is_stopping
+                outputs = (is_hunting, is_stopping, render_hunting_status(version, state) if is_visible else "")
+                if outputs == last_outputs:
+                    # 超时也返回一次空的更新，页面关闭后生成器可以及时结束
+                    yield {gr_hunting_status: gr.Markdown()}
+                    continue
+                last_outputs = outputs
+                yield {
+                    gr_hunting_start_button: gr.Button(visible=not is_visible),
+                    gr_hunting_stop_button: gr.Button(visible=is_hunting),
+                    gr_hunting_logs: gr.Textbox(visible=is_visible),
+                    gr_hunting_status: gr.Markdown(visible=is_visible, value=outputs[2]),
+                }
 
 
         def check_hunting_status():
-            is_hunting = os.path.exists(os.path.join(DATA_DIR, "running.state"))
+            status = hunt_supervisor.status()
+            is_hunting, is_stopping = status["running"], status["stopping"]
             return {
-                gr_hunting_start_button: gr.Button(visible=not is_hunting),
+                gr_hunting_start_button: gr.Button(visible=not is_hunting and not is_stopping),
                 gr_hunting_stop_button: gr.Button(visible=is_hunting),
-                gr_hunting_logs: gr.Textbox(visible=is_hunting),
+                gr_hunting_logs: gr.Textbox(visible=is_hunting or is_stopping),
             }
 
 
@@ -592,7 +653,7 @@ with gr.Blocks(title="AutoDL GPU Hunter", theme=gr.themes.Default(text_size="lg"
         )
 
         # 开始
-        hunting_job = gr_hunting_start_button.click(
+        gr_hunting_start_button.click(
             hunting_start,
             [
                 gr_gpu_types,
@@ -631,7 +692,6 @@ with gr.Blocks(title="AutoDL GPU Hunter", theme=gr.themes.Default(text_size="lg"
                 gr_hunting_stop_button,
                 gr_hunting_logs,
             ],
-            cancels=[hunting_job],
         )
 
         gr_is_token_ready.change(
@@ -644,8 +704,17 @@ with gr.Blocks(title="AutoDL GPU Hunter", theme=gr.themes.Default(text_size="lg"
             ]
         )
 
+        # 状态
+        demo.load(
+            stream_hunting_status,
+            None,
+            [gr_hunting_start_button, gr_hunting_stop_button, gr_hunting_logs, gr_hunting_status],
+            show_progress="hidden",
+            concurrency_limit=None,
+        )
+
         # 日志
-        demo.load(read_output_logs, None, gr_hunting_logs, every=1)
+        demo.load(read_output_logs, [gr_hunting_logs_tail], [gr_hunting_logs, gr_hunting_logs_tail], every=1)
 
     with gr.Tab("🐰 算力实况", visible=False) as gr_stat_tab:
         gr.Markdown("## 当前 GPU 主机数量")
@@ -659,7 +728,7 @@ with gr.Blocks(title="AutoDL GPU Hunter", theme=gr.themes.Default(text_size="lg"
 
 
         def refresh_stat(gpu_type_names=None):
-            region_list = RegionList().update()
+            region_list = RegionList().update(history=get_gpu_history(Config().load()))
             return load_stat(gpu_type_names, region_list)
 
 
@@ -673,7 +742,7 @@ with gr.Blocks(title="AutoDL GPU Hunter", theme=gr.themes.Default(text_size="lg"
                 "RTX 3060",
             ]
             return {
-                **update_matrix(gpu_type_names),
+                **update_matrix(gpu_type_names, region_list),
                 gr_gpu_checkbox_group: gr.CheckboxGroup(choices=region_list.get_gpu_type_names(), value=gpu_type_names),
                 gr_stat_note: gr.Markdown(
                     f"以上是当前 AutoDL 官网查询到的 GPU 主机数量，更新时间："
@@ -682,17 +751,18 @@ with gr.Blocks(title="AutoDL GPU Hunter", theme=gr.themes.Default(text_size="lg"
             }
 
 
-        def update_matrix(gpu_type_names):
-            region_list = RegionList().load()
+        def update_matrix(gpu_type_names, region_list=None):
+            region_list = region_list or RegionList().load()
+            region_names, _, _ = region_list.get_matrix()
             return {
                 gr_gpu_region_matrix: gr.Matrix(
                     headers=["地区"] + [n for n in gpu_type_names],
                     value=[
-                        [r["region_name"]] + [
-                            region_list.get_region_stats([gn], [r["region_name"]])[0]["idle_gpu_num"] or ""
+                        [region_name] + [
+                            region_list.get_region_gpu_stats(region_name, gn)["idle_gpu_num"] or ""
                             for gn in gpu_type_names
                         ]
-                        for r in region_list.get_region_stats()
+                        for region_name in region_names
                     ]
                 ),
             }
@@ -717,7 +787,7 @@ with gr.Blocks(title="AutoDL GPU Hunter", theme=gr.themes.Default(text_size="lg"
             config = Config().load()
         if config.token:
             try:
-                RegionList().update()
+                RegionList().update(history=get_gpu_history(config))
             except FailedError as e:
                 error_message = str(e)
                 if "登录失败，请重试" in error_message:
@@ -1,15 +1,55 @@
+import asyncio
 import datetime
+import threading
 import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor, wait
+from json import loads as json_loads
 
 import requests
-from requests import RequestException
-from retry import retry
+from requests.adapters import HTTPAdapter
 
-from gpuhunter.utils.helpers import url_set_params
+from gpuhunter.utils.helpers import url_set_params, ttl_cache
+from gpuhunter.utils.logging import LazyRepr, configure_payload_logging, debug_payload
+from gpuhunter.utils.metrics import metrics
+from gpuhunter.utils.ratelimit import TokenBucket
+from gpuhunter.utils.retrying import RetryPolicy, CircuitBreaker, CircuitOpenError
 from main import logger
 
 INSTANCE_RUNNING_STATUSES = ["creating", "starting", "running", "re_initializing"]
 
+metrics.describe("autodl_api_request_seconds", "Latency of AutoDL API requests.")
+metrics.describe("autodl_api_requests_total", "Number of AutoDL API requests by HTTP status.")
+metrics.describe("autodl_api_response_bytes_total", "Bytes received from AutoDL API.")
+metrics.describe("autodl_api_retries_total", "Number of retried AutoDL API requests.")
+metrics.describe("autodl_api_responses_total", "Number of AutoDL API responses by result code.")
+
+# 各接口的限流权重和优先级 (weight, priority)，priority 数值越小越优先，未列出的接口使用 DEFAULT_API_RATE_LIMIT
+API_RATE_LIMITS = {
+    "/api/v1/order/instance/create/payg": (1, 0),
+    "/api/v1/order/instance/clone/payg": (1, 0),
+    "/api/v1/instance/name": (1, 1),
+    "/api/v1/instance/timed/shutdown": (1, 1),
+    "/api/v1/machine/region/gpu_type": (1, 3),
+    "/api/v1/user/machine/list": (2, 5),
+    "/api/v1/instance": (2, 5),
+}
+DEFAULT_API_RATE_LIMIT = (1, 4)
+# 所有客户端（包括 AsyncAutodlClient）共用的限流器，load_config 时按 Config 修改速率
+api_rate_limiter = TokenBucket(10, 20)
+
+# 各接口的重试策略：创建实例不重试（重复提交可能会创建多个实例），尽快失败以便尝试下一台机器；
+# 列表类接口在扫描的热路径上，只做少量快速的重试；其它元数据接口在后台耐心重试。
+API_RETRY_POLICIES = {
+    "/api/v1/order/instance/create/payg": RetryPolicy(tries=1, deadline=15, timeout=15),
+    "/api/v1/order/instance/clone/payg": RetryPolicy(tries=1, deadline=15, timeout=15),
+    "/api/v1/instance/name": RetryPolicy(tries=4, delay=1, max_delay=5, deadline=30),
+    "/api/v1/instance/timed/shutdown": RetryPolicy(tries=4, delay=1, max_delay=5, deadline=30),
+    "/api/v1/user/machine/list": RetryPolicy(tries=3, delay=0.5, max_delay=2, deadline=20),
+    "/api/v1/machine/region/gpu_type": RetryPolicy(tries=3, delay=0.5, max_delay=2, deadline=15),
+}
+DEFAULT_RETRY_POLICY = RetryPolicy(tries=6, delay=2, max_delay=60, deadline=300, timeout=30)
+
 
 class FailedError(Exception):
     pass
@@ -20,14 +60,87 @@ class AutodlClient:
         self.api_host = "https://api.autodl.com"
         self.backend_host = "https://fe-config-backend.autodl.com"
         self.token = None
+        self.pool_connections = 10
+        self.pool_maxsize = 10
+        self.list_page_workers = 1
+        self.region_fetch_workers = 8
+        self.region_fetch_timeout_seconds = 15
+        self.rate_limiter = api_rate_limiter
         self.__dict__.update(kwargs)
         self._conf = kwargs
+        self._session = None
+        self._circuit_breakers = {}
+        self._request_count_lock = threading.Lock()
+        self.request_count = 0
+
+    @property
+    def session(self):
+        if self._session is None:
+            # 复用连接池，保持长连接，避免每次请求都重新握手
+            adapter = HTTPAdapter(pool_connections=self.pool_connections, pool_maxsize=self.pool_maxsize)
+            session = requests.Session()
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            self._session = session
+        return self._session
+
+    def get_circuit_breaker(self, host):
+        if (circuit_breaker := self._circuit_breakers.get(host)) is None:
+            circuit_breaker = self._circuit_breakers.setdefault(host, CircuitBreaker(host))
+        return circuit_breaker
+
+    def close(self):
+        if self._session is not None:
+            self._session.close()
+            self._session = None
+
+    def get_connection_stats(self):
+        """
+        :return: {
+          "api.autodl.com": {
+            "requests": 42,
+            "connections": 1,
+            "reused": 41
+          }
+        }
+        """
+        stats = {}
+        if self._session is None:
+            return stats
+        for adapter in set(self._session.adapters.values()):
+            for key in adapter.poolmanager.pools.keys():
+                pool = adapter.poolmanager.pools.get(key)
+                if pool is None:
+                    continue
+                host_stats = stats.setdefault(pool.host, {"requests": 0, "connections": 0, "reused": 0})
+                host_stats["requests"] += pool.num_requests
+                host_stats["connections"] += pool.num_connections
+                host_stats["reused"] = max(0, host_stats["requests"] - host_stats["connections"])
+        return stats
 
     def load_config(self):
         from gpuhunter.data_object import Config
         config = Config()
         config.load()
+        # 先检查限速设置，设置无效时不影响其它设置，沿用之前的速率
+        rate_limit = (config.rate_limit_per_second, config.rate_limit_burst)
+        try:
+            TokenBucket.check(*rate_limit)
+        except (TypeError, ValueError):
+            logger.error(f"限速设置无效，沿用之前的设置：rate_limit_per_second={rate_limit[0]!r}，"
+                         f"rate_limit_burst={rate_limit[1]!r}。"
+                         f" Invalid rate limit, keep the previous one: rate_limit_per_second={rate_limit[0]!r},"
+                         f" rate_limit_burst={rate_limit[1]!r}.")
+            rate_limit = None
         self.token = config.token
+        # 更换 Token 后，之前账号的镜像信息不再可用
+        resolve_image_info.cache_clear()
+        self.list_page_workers = config.list_page_workers
+        self.region_fetch_workers = config.region_fetch_workers
+        self.region_fetch_timeout_seconds = config.region_fetch_timeout_seconds
+        if rate_limit is not None:
+            self.rate_limiter.configure(*rate_limit)
+        configure_payload_logging(config.log_payload_sample_rate, config.log_payload_max_length)
 
     def create_instance(self, machine_id, image, instance_name="",
                         private_image_uuid="", reproduction_uuid="", reproduction_id=0,
@@ -91,7 +204,7 @@ class AutodlClient:
                             else shutdown_at),
             **kwargs,
         }
-        self.request(api, body=body)
+        return self.request(api, body=body)
 
     def update_instance_name(self, instance_uuid, instance_name, **kwargs):
         api = "/api/v1/instance/name"
@@ -100,7 +213,7 @@ class AutodlClient:
             "instance_name": instance_name,
             **kwargs,
         }
-        self.request(api, body=body, method="PUT")
+        return self.request(api, body=body, method="PUT")
 
     def get_private_images(self, **kwargs):
         """
@@ -414,20 +527,60 @@ class AutodlClient:
         }
         return self.request(api, params=params, method="GET")
 
-    def list_request(self, api, body):
-        page_index = 1
-        while True:
-            body["page_index"] = page_index
-            data = self.request(api, body=body)
-            for item in data["list"]:
-                yield item
-            page_index += 1
-            if page_index > data["max_page"]:
-                break
-            time.sleep(0.2)
-
-    @retry(RequestException, 6, 5, backoff=2, logger=logger)
-    def request(self, api_url, params=None, method="POST", body=None):
+    def list_request(self, api, body, page_workers=None):
+        """
+        按页码顺序逐条返回列表数据。拿到第一页的 max_page 后，
+        如果 page_workers > 1，剩余的页面会在线程池中并发获取（仍受 rate_limiter 限速）。
+        """
+        page_workers = self.list_page_workers if page_workers is None else page_workers
+        data = self.request(api, body={**body, "page_index": 1})
+        for item in data["list"]:
+            yield item
+        page_indexes = range(2, data["max_page"] + 1)
+        if len(page_indexes) == 0:
+            return
+        if page_workers <= 1:
+            for page_index in page_indexes:
+                data = self.request(api, body={**body, "page_index": page_index})
+                for item in data["list"]:
+                    yield item
+        else:
+            executor = ThreadPoolExecutor(max_workers=min(page_workers, len(page_indexes)))
+            futures = [
+                executor.submit(self.request, api, body={**body, "page_index": page_index})
+                for page_index in page_indexes
+            ]
+            try:
+                for future in futures:
+                    for item in future.result()["list"]:
+                        yield item
+            finally:
+                # 调用方提前结束迭代时，取消还没开始的页面请求
+                for future in futures:
+                    future.cancel()
+                executor.shutdown(wait=False)
+
+    def wait_rate_limit(self, api_url):
+        """
+        按接口的权重和优先级等待令牌，创建实例等高优先级的调用不会排在列表分页请求的后面。
+        """
+        weight, priority = API_RATE_LIMITS.get(urllib.parse.urlparse(api_url).path, DEFAULT_API_RATE_LIMIT)
+        if (wait_seconds := self.rate_limiter.acquire(weight, priority)) > 0.5:
+            logger.debug("rate limited, api_url: %s, waited: %.2fs", api_url, wait_seconds)
+
+    async def wait_rate_limit_async(self, api_url):
+        """
+        wait_rate_limit 的 asyncio 版本，与同步请求共用同一个限流器。
+        """
+        weight, priority = API_RATE_LIMITS.get(urllib.parse.urlparse(api_url).path, DEFAULT_API_RATE_LIMIT)
+        if (wait_seconds := await self.rate_limiter.acquire_async(weight, priority)) > 0.5:
+            logger.debug("rate limited, api_url: %s, waited: %.2fs", api_url, wait_seconds)
+
+    def count_request(self):
+        with self._request_count_lock:
+            self.request_count += 1
+
+    def build_request(self, api_url, params=None):
         url = api_url if api_url.startswith("https://") else f"{self.api_host}{api_url}"
         if params:
             url = url_set_params(url, **params)
@@ -435,18 +588,168 @@ class AutodlClient:
             "Authorization": self.token,
             "Content-Type": "application/json"
         }
-        logger.debug(url)
-        logger.debug(method)
-        logger.debug(body)
-        response = requests.request(method, url, json=body, headers=headers)
-        json = response.json()
+        # 没有 Token 时不发送 Authorization，requests 会忽略值为 None 的请求头，aiohttp 则会报错
+        return url, {k: v for k, v in headers.items() if v is not None}
+
+    @staticmethod
+    def parse_response(json):
         if json["code"] not in ["Success", "OK"]:
             logger.error(json)
             raise FailedError(json["msg"])
         else:
-            logger.debug(json["data"])
+            debug_payload(logger, "response data", json["data"])
             return json["data"]
 
+    @staticmethod
+    def get_retry_policy(url):
+        return API_RETRY_POLICIES.get(urllib.parse.urlparse(url).path, DEFAULT_RETRY_POLICY)
+
+    def request(self, api_url, params=None, method="POST", body=None):
+        url, headers = self.build_request(api_url, params)
+        logger.debug("%s %s, body: %s", method, url, LazyRepr(body))
+        retry_policy = self.get_retry_policy(url)
+        path = urllib.parse.urlparse(url).path
+        attempts = 0
+
+        def send():
+            nonlocal attempts
+            attempts += 1
+            self.wait_rate_limit(api_url)
+            self.count_request()
+            started_at = time.monotonic()
+            try:
+                response = self.session.request(method, url, json=body, headers=headers,
+                                                timeout=retry_policy.timeout)
+            except Exception:
+                self.observe_request(path, started_at, "error")
+                raise
+            self.observe_request(path, started_at, response.status_code, len(response.content))
+            return response.json()
+
+        try:
+            json = retry_policy.call(send, self.get_circuit_breaker(urllib.parse.urlparse(url).netloc))
+        finally:
+            if attempts > 1:
+                metrics.inc("autodl_api_retries_total", attempts - 1, path=path)
+        metrics.inc("autodl_api_responses_total", path=path, code=json.get("code"))
+        return self.parse_response(json)
+
+    @staticmethod
+    def observe_request(path, started_at, status, size=0):
+        metrics.observe("autodl_api_request_seconds", time.monotonic() - started_at, path=path)
+        metrics.inc("autodl_api_requests_total", path=path, status=status)
+        if size:
+            metrics.inc("autodl_api_response_bytes_total", size, path=path)
+
+
+class AsyncAutodlClient(AutodlClient):
+    """
+    AutodlClient 的 asyncio 版本，方法与 AutodlClient 相同，但都需要 await，
+    list_instance / list_machine 返回异步生成器（async for）。
+    同一个事件循环中的所有实例共享一个 aiohttp 连接池，asyncio.run 结束时自动关闭。
+    """
+    # {事件循环: (aiohttp.ClientSession, 负责关闭它的异步生成器)}
+    _shared_sessions = {}
+
+    @property
+    def session(self):
+        import aiohttp
+        loop = asyncio.get_running_loop()
+        for closed_loop in [l for l in self._shared_sessions if l.is_closed()]:
+            del self._shared_sessions[closed_loop]
+        session, _ = self._shared_sessions.get(loop, (None, None))
+        if session is None or session.closed:
+            connector = aiohttp.TCPConnector(limit=self.pool_maxsize * self.pool_connections,
+                                             limit_per_host=self.pool_maxsize)
+            session = aiohttp.ClientSession(connector=connector)
+            # 启动后事件循环会记录这个生成器，关闭前调用 shutdown_asyncgens（asyncio.run 会调用）时关闭连接池，
+            # 事件循环关闭后就无法再关闭了
+            closer = self._close_on_shutdown(session)
+            try:
+                closer.asend(None).send(None)
+            except StopIteration:
+                pass
+            self._shared_sessions[loop] = (session, closer)
+        return session
+
+    @staticmethod
+    async def _close_on_shutdown(session):
+        try:
+            yield
+        finally:
+            await session.close()
+
+    @classmethod
+    async def close_shared_session(cls):
+        if shared := cls._shared_sessions.pop(asyncio.get_running_loop(), None):
+            await shared[1].aclose()
+
+    async def list_request(self, api, body, page_workers=None):
+        page_workers = self.list_page_workers if page_workers is None else page_workers
+        data = await self.request(api, body={**body, "page_index": 1})
+        for item in data["list"]:
+            yield item
+        page_indexes = range(2, data["max_page"] + 1)
+        if len(page_indexes) == 0:
+            return
+        semaphore = asyncio.Semaphore(max(1, page_workers))
+
+        async def fetch_page(page_index):
+            async with semaphore:
+                return await self.request(api, body={**body, "page_index": page_index})
+
+        tasks = [asyncio.ensure_future(fetch_page(page_index)) for page_index in page_indexes]
+        try:
+            for task in tasks:
+                for item in (await task)["list"]:
+                    yield item
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def request(self, api_url, params=None, method="POST", body=None):
+        import aiohttp
+        url, headers = self.build_request(api_url, params)
+        logger.debug("%s %s, body: %s", method, url, LazyRepr(body))
+        retry_policy = self.get_retry_policy(url)
+        path = urllib.parse.urlparse(url).path
+        attempts = 0
+
+        async def send():
+            nonlocal attempts
+            attempts += 1
+            await self.wait_rate_limit_async(api_url)
+            self.count_request()
+            started_at = time.monotonic()
+            try:
+                async with self.session.request(method, url, json=body, headers=headers,
+                                                timeout=aiohttp.ClientTimeout(total=retry_policy.timeout)) as response:
+                    content = await response.read()
+            except Exception:
+                self.observe_request(path, started_at, "error")
+                raise
+            self.observe_request(path, started_at, response.status, len(content))
+            try:
+                return json_loads(content)
+            except ValueError as e:
+                # 网关错误等返回的 HTML 页面，与 requests 一样当作网络错误，可以重试并计入熔断
+                raise aiohttp.ClientResponseError(
+                    response.request_info, response.history, status=response.status,
+                    message=f"Invalid JSON response: {e}",
+                ) from e
+
+        try:
+            json = await retry_policy.call_async(
+                send,
+                self.get_circuit_breaker(urllib.parse.urlparse(url).netloc),
+                exceptions=(aiohttp.ClientError, asyncio.TimeoutError, CircuitOpenError),
+            )
+        finally:
+            if attempts > 1:
+                metrics.inc("autodl_api_retries_total", attempts - 1, path=path)
+        metrics.inc("autodl_api_responses_total", path=path, code=json.get("code"))
+        return self.parse_response(json)
+
 
 def get_default_client():
     client = AutodlClient()
@@ -454,20 +757,141 @@ def get_default_client():
     return client
 
 
-def get_available_machines(region_sign_list, gpu_type_name, gpu_idle_num=1, count=10, min_expand_data_disk=0, **kwargs):
-    machines = []
+def get_default_async_client():
+    client = AsyncAutodlClient()
+    client.load_config()
+    return client
+
+
+def iter_available_machines(region_sign_list, gpu_type_name, gpu_idle_num=1, min_expand_data_disk=0, **kwargs):
+    """
+    逐条返回可用的机器，后面的页面还在下载时，前面符合要求的机器就可以先交给调用方处理。
+    """
     for mch in autodl_client.list_machine(region_sign_list, gpu_type_name, gpu_idle_num, **kwargs):
         if mch["gpu_idle_num"] >= gpu_idle_num \
                 and mch["gpu_order_num"] >= gpu_idle_num \
                 and mch["max_data_disk_expand_size"] >= min_expand_data_disk:
-            machines.append(mch)
+            yield mch
+
+
+def get_available_machines(region_sign_list, gpu_type_name, gpu_idle_num=1, count=10, min_expand_data_disk=0,
+                           order_by=None, **kwargs):
+    """
+    :param order_by: 按机器字段排序后再取前 count 台，例如 ["payg_price", "-cpu_per_gpu"]，
+        排序时需要获取全部页面的机器，参见 MachineTable.rank
+    """
+    if order_by:
+        from gpuhunter.machine_table import MachineTable
+        table = MachineTable(iter_available_machines(region_sign_list, gpu_type_name, gpu_idle_num,
+                                                     min_expand_data_disk, **kwargs))
+        machines = [r.data for r in table.rank(order_by=order_by)]
+        return machines if count is None else machines[:count]
+    machines = []
+    for mch in iter_available_machines(region_sign_list, gpu_type_name, gpu_idle_num, min_expand_data_disk,
+                                       **kwargs):
+        machines.append(mch)
         if count is not None and len(machines) == count:
             break
     return machines
 
 
+def get_region_idle_gpus(region_list, region_names, gpu_type_names=None, workers=None, timeout_seconds=None):
+    """
+    只查询目标地区的 GPU 空闲数量，比 RegionList.fetch 和 list_machine 的开销小得多。
+    超时或出错的地区沿用 region_list 中的数据，不影响其它地区。
+    :param region_list: RegionList，用于把 region_name 转换为 region_sign
+    :param workers: 并发请求数，默认为 Config.region_fetch_workers
+    :param timeout_seconds: 等待所有地区返回的时间，默认为 Config.region_fetch_timeout_seconds
+    :return: {
+      "西北B区": {
+        "RTX 4090": 3
+      }
+    }
+    """
+    workers = workers or autodl_client.region_fetch_workers
+    timeout_seconds = timeout_seconds or autodl_client.region_fetch_timeout_seconds
+    regions = [r for r in region_list.list if r["region_name"] in region_names]
+    if len(regions) == 0:
+        return {}
+    executor = ThreadPoolExecutor(max_workers=max(1, min(workers, len(regions))))
+    futures = [executor.submit(autodl_client.get_region_gpu_types, r["region_sign"]) for r in regions]
+    wait(futures, timeout=timeout_seconds)
+    for future in futures:
+        future.cancel()
+    executor.shutdown(wait=False)
+    idle_gpus = {}
+    for r, future in zip(regions, futures):
+        if future.done() and not future.cancelled() and (e := future.exception()) is not None:
+            logger.warning(f"查询地区 GPU 空闲数量失败，沿用上次的数据：{r['region_name']}，{e!r}。"
+                           f" Failed to fetch idle GPUs, keep the last known stats: {r['region_name']}, {e!r}.")
+            gpu_types = {g["gpu_type"]: g["idle_gpu_num"] for g in r["gpu_types"]}
+        elif future.done() and not future.cancelled():
+            gpu_types = {
+                gpu_type: stats["idle_gpu_num"]
+                for g in future.result()
+                for gpu_type, stats in g.items()
+            }
+        else:
+            logger.warning(f"查询地区 GPU 空闲数量超时，沿用上次的数据：{r['region_name']}。"
+                           f" Fetching idle GPUs timed out, keep the last known stats: {r['region_name']}.")
+            gpu_types = {g["gpu_type"]: g["idle_gpu_num"] for g in r["gpu_types"]}
+        idle_gpus[r["region_name"]] = {
+            gpu_type: idle_gpu_num
+            for gpu_type, idle_gpu_num in gpu_types.items()
+            if not gpu_type_names or gpu_type in gpu_type_names
+        }
+    return idle_gpus
+
+
+class InstanceCache:
+    """
+    运行中实例的缓存，按 uuid 索引。超过 max_age 秒才完整刷新一次，
+    新创建的实例通过 add 立即加入缓存，空闲的扫描周期不必每次都重新下载整个实例列表。
+    实例列表可能还没有包含刚创建的实例，通过 add 加入的实例在刷新时保留，直到出现在实例列表中或者超过 max_age 秒。
+    """
+
+    def __init__(self):
+        self.instances = {}
+        self.added = {}
+        self.refreshed_at = None
+        self.lock = threading.Lock()
+
+    def get_instances(self, max_age=None, force=False):
+        with self.lock:
+            if force or self.refreshed_at is None \
+                    or max_age is not None and time.time() - self.refreshed_at >= max_age:
+                instances = {
+                    inst["uuid"]: inst
+                    for inst in autodl_client.list_instance(INSTANCE_RUNNING_STATUSES)
+                }
+                now = time.time()
+                for uuid, (added_at, inst) in list(self.added.items()):
+                    if uuid in instances or max_age is not None and now - added_at >= max_age:
+                        del self.added[uuid]
+                    else:
+                        instances[uuid] = inst
+                self.instances = instances
+                self.refreshed_at = now
+            return list(self.instances.values())
+
+    def add(self, instance):
+        with self.lock:
+            self.instances[instance["uuid"]] = instance
+            self.added[instance["uuid"]] = (time.time(), instance)
+
+    def invalidate(self):
+        with self.lock:
+            self.instances = {}
+            self.added = {}
+            self.refreshed_at = None
+
+
 def get_running_instances(region_names=None, gpu_type_names=None, image=None, private_image_uuid=None,
-                          reproduction_uuid=None, reproduction_id=None):
+                          reproduction_uuid=None, reproduction_id=None, instances=None):
+    """
+    :param instances: 已经获取的运行中的实例列表，为 None 时从接口获取
+    """
+
     def match(inst):
         return (region_names is None or inst["region_name"] in region_names) \
             and (gpu_type_names is None or inst["snapshot_gpu_alias_name"] in gpu_type_names) \
@@ -478,11 +902,12 @@ def get_running_instances(region_names=None, gpu_type_names=None, image=None, pr
 
     return [
         inst
-        for inst in autodl_client.list_instance(INSTANCE_RUNNING_STATUSES)
+        for inst in (autodl_client.list_instance(INSTANCE_RUNNING_STATUSES) if instances is None else instances)
         if match(inst)
     ]
 
 
+@ttl_cache(3600, maxsize=8)
 def resolve_image_info(base_image_labels=None, shared_image_keyword=None,
                        shared_image_username_keyword=None, shared_image_version=None,
                        private_image_uuid=None, private_image_name=None):
@@ -546,3 +971,4 @@ def resolve_image_info(base_image_labels=None, shared_image_keyword=None,
 
 
 autodl_client = get_default_client()
+instance_cache = InstanceCache()
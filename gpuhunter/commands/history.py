@@ -0,0 +1,29 @@
+import time
+from datetime import datetime
+
+
+def get_help():
+    return "查看 GPU 空闲数量的历史记录。 Show the history of idle GPUs."
+
+
+def add_arguments(parser):
+    parser.add_argument("--region", action="append", dest="region_names",
+                        help="地区，可以指定多个。 Region name, can be repeated.")
+    parser.add_argument("--gpu", action="append", dest="gpu_types",
+                        help="显卡型号，可以指定多个。 GPU type, can be repeated.")
+    parser.add_argument("--days", type=float, default=7,
+                        help="最近多少天，默认 7 天。 Number of recent days, 7 by default.")
+    parser.add_argument("--bucket-hours", type=float, default=1,
+                        help="按多少小时汇总，默认 1 小时。 Hours per row, 1 by default.")
+
+
+def main(region_names=None, gpu_types=None, days=7, bucket_hours=1):
+    from gpuhunter.data_object import Config
+    from gpuhunter.gpu_history import GpuHistory
+    history = GpuHistory.from_config(Config().load())
+    records = history.query(region_names, gpu_types, since=time.time() - days * 86400)
+    for b in history.aggregate(records, int(bucket_hours * 3600)):
+        print(f'{datetime.fromtimestamp(b["time"]).strftime("%Y-%m-%d %H:%M")}'
+              f'\t{b["region_name"]}\t{b["gpu_type"]}'
+              f'\tmax={b["idle_gpu_num_max"]}\tavg={b["idle_gpu_num_avg"]:.1f}'
+              f'\tavailable={b["available_ratio"]:.0%}\tsamples={b["samples"]}')
@@ -0,0 +1,37 @@
+import time
+
+from main import logger
+
+
+def get_help():
+    return "同时蹲守 hunt_list.json 中的多个任务。 Run all hunts in hunt_list.json at once."
+
+
+def add_arguments(parser):
+    from gpuhunter.commands.wait import add_arguments as add_wait_arguments
+    add_wait_arguments(parser)
+
+
+def main(metrics_port=None, metrics_host="127.0.0.1"):
+    from gpuhunter.autodl_client import autodl_client, instance_cache
+    from gpuhunter.commands.wait import run_scan_cycle, start_metrics_server
+    from gpuhunter.data_object import Config
+    from gpuhunter.hunt_engine import MultiHuntEngine
+    from gpuhunter.scheduler import ScanScheduler
+    engine = MultiHuntEngine.from_data()
+    if len(engine.hunts) == 0:
+        logger.info(f"没有蹲守任务，请先在 hunt_list.json 中添加。"
+                    f" No hunts found, please add them to hunt_list.json first.")
+        return
+    start_metrics_server(metrics_port, metrics_host)
+    instance_cache.invalidate()
+    scheduler = ScanScheduler.from_config(Config().load())
+    while True:
+        request_count = autodl_client.request_count
+        if not run_scan_cycle(engine.run_cycle, scheduler):
+            # 否则等待一段时间后重试
+            interval, reason = scheduler.next_interval(autodl_client.request_count - request_count)
+            logger.debug("wait for next retry, interval: %r, reason: %s", interval, reason)
+            time.sleep(interval)
+        else:
+            break
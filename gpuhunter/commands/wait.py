@@ -1,12 +1,32 @@
 import os
 import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import timedelta, datetime
 from smtplib import SMTPException
 
+from requests import RequestException
+
 from gpuhunter.autodl_client import FailedError
+from gpuhunter.utils.events import hunt_events
 from gpuhunter.utils.helpers import end_of_day
+from gpuhunter.utils.logging import debug_payload
+from gpuhunter.utils.metrics import metrics
 from main import logger
 
+metrics.describe("hunter_scans_total", "Number of scan cycles.")
+metrics.describe("hunter_scan_errors_total", "Number of scan cycles failed by network errors.")
+metrics.describe("hunter_scan_seconds", "Duration of scan cycles.")
+metrics.describe("hunter_phase_seconds", "Duration of each phase in a scan cycle.")
+metrics.describe("hunter_idle_gpus", "Idle GPUs seen per region and GPU type.")
+metrics.describe("hunter_machines_matched", "Machines matched in the last scan cycle.")
+metrics.describe("hunter_instance_create_attempts_total", "Number of instance creation attempts.")
+metrics.describe("hunter_instance_create_total", "Number of instance creations by result.")
+metrics.describe("hunter_started_at_seconds", "Unix time when hunting started.")
+metrics.describe("hunter_time_to_first_instance_seconds", "Seconds from hunting start to the first created instance.")
+metrics.describe("autodl_http_requests", "HTTP requests sent through the connection pool per host.")
+metrics.describe("autodl_http_connections", "HTTP connections opened per host.")
+metrics.describe("autodl_http_reused_requests", "HTTP requests that reused an open connection per host.")
+
 
 def after_finished(config, created_instance_names=None):
     # 如果需要，发送完成邮件
@@ -41,22 +61,114 @@ def after_finished(config, created_instance_names=None):
         os.system("shutdown -h")
 
 
-def try_to_create_instances():
-    from gpuhunter.autodl_client import (
-        autodl_client, resolve_image_info,
-        get_running_instances, get_available_machines
-    )
-    from gpuhunter.data_object import Config, RegionList
+def create_instance_on_machine(machine, config, image_info, region_clone_uuid_map):
+    """
+    在指定机器上创建实例，并设置实例名称和定时关机，成功时返回实例的描述，失败时返回 None。
+    """
+    from gpuhunter.autodl_client import autodl_client, instance_cache
+    metrics.inc("hunter_instance_create_attempts_total")
+    try:
+        # 创建实例
+        instance_uuid = autodl_client.create_instance(
+            machine["machine_id"],
+            image_info["image"],
+            private_image_uuid=image_info["private_image_uuid"],
+            reproduction_uuid=image_info["reproduction_uuid"],
+            reproduction_id=image_info["reproduction_id"],
+            req_gpu_amount=config.gpu_idle_num,
+            expand_data_disk=config.expand_data_disk,
+            clone_instance_uuid=region_clone_uuid_map.get(machine["region_sign"]),
+            copy_data_disk_after_clone=config.copy_data_disk_after_clone,
+            keep_src_user_service_address_after_clone=config.keep_src_user_service_address_after_clone,
+        )
+        # 下单成功后立即加入缓存（即使后续设置失败），下一轮扫描不必重新获取整个实例列表
+        instance_cache.add({
+            "uuid": instance_uuid,
+            "machine_id": machine["machine_id"],
+            "machine_alias": machine["machine_alias"],
+            "region_sign": machine["region_sign"],
+            "region_name": machine["region_name"],
+            "snapshot_gpu_alias_name": machine["gpu_name"],
+            "status": "creating",
+            "image": image_info["image"],
+            "private_image_uuid": image_info["private_image_uuid"],
+            "reproduction_uuid": image_info["reproduction_uuid"],
+            "reproduction_id": image_info["reproduction_id"],
+        })
+        # 设置实例名称
+        autodl_client.update_instance_name(instance_uuid, "🎁🐒")
+        # 设置定时关机
+        shutdown_at = None
+        if config.shutdown_instance_after_hours:
+            shutdown_at = datetime.now() + timedelta(hours=config.shutdown_instance_after_hours)
+        elif config.shutdown_instance_today:
+            shutdown_at = end_of_day(datetime.now())
+        if shutdown_at:
+            logger.debug("shutdown planned, instance_uuid: %r, shutdown_at: %r", instance_uuid, shutdown_at)
+            autodl_client.update_instance_shutdown(instance_uuid, shutdown_at)
+        instance_name = f'{machine["region_name"]} / {machine["machine_alias"]}' \
+                        f' ({machine["gpu_name"]}, {instance_uuid})'
+        logger.info(f"已创建实例：{instance_name}。"
+                    f" Instance has been created: {instance_name}.")
+        metrics.inc("hunter_instance_create_total", result="success")
+        hunt_events.publish("instance_created", last_created_instance=instance_name)
+        if (started_at := metrics.get("hunter_started_at_seconds")) is not None:
+            metrics.setdefault("hunter_time_to_first_instance_seconds", time.time() - started_at)
+        return instance_name
+    except (FailedError, RequestException) as e:
+        metrics.inc("hunter_instance_create_total", result="failure")
+        hunt_events.publish("instance_create_failed", last_create_error=repr(e))
+        # 请求超时等情况下实例可能已经创建，下一轮扫描重新获取完整的实例列表
+        instance_cache.invalidate()
+        logger.debug("create instance error: %r", e)
+        logger.error(f'{machine["region_name"]} {machine["machine_alias"]} {machine["gpu_name"]}'
+                     f' ({machine["machine_id"]})')
+        logger.error(f"使用以上机器创建实例时发生错误，跳过并继续..."
+                     f" An error occurred while creating the instance with the above machine,"
+                     f" skip and continue...")
+        return None
 
-    # 加载数据和配置
-    config = Config().load()
-    region_list = RegionList().update()
-    region_sign_list = [s for r in region_list.list if r["region_name"] in config.region_names
-                        for s in r["region_sign"]]
-    logger.debug(f"config: {config.to_dict()!r}")
-    logger.debug(f"region_list.list: {region_list.to_dict()!r}")
 
-    # 如果有克隆目标，确保使用同区域的机器
+def create_instances(machines, config, image_info, region_clone_uuid_map):
+    """
+    在每台机器上创建实例，如果开启了 config.create_concurrently，则同时在所有机器上创建。
+    :return: 创建成功的实例描述列表
+    """
+    if config.create_concurrently and len(machines) > 1:
+        with ThreadPoolExecutor(max_workers=len(machines)) as executor:
+            results = list(executor.map(
+                lambda m: create_instance_on_machine(m, config, image_info, region_clone_uuid_map),
+                machines
+            ))
+    else:
+        results = [create_instance_on_machine(m, config, image_info, region_clone_uuid_map) for m in machines]
+    return [r for r in results if r is not None]
+
+
+def stream_create_instances(machines, count, config, image_info, region_clone_uuid_map):
+    """
+    从 machines 迭代器中每拿到一台机器就立即开始创建实例，最多创建 count 个。
+    :return: (已派发的机器列表, 创建成功的实例描述列表)
+    """
+    dispatched_machines = []
+    futures = []
+    with ThreadPoolExecutor(max_workers=max(1, count)) as executor:
+        for machine in machines:
+            dispatched_machines.append(machine)
+            futures.append(executor.submit(create_instance_on_machine, machine, config, image_info,
+                                           region_clone_uuid_map))
+            if len(dispatched_machines) >= count:
+                break
+        results = [f.result() for f in futures]
+    return dispatched_machines, [r for r in results if r is not None]
+
+
+def get_region_sign_list(region_list, region_names):
+    return [s for r in region_list.list if r["region_name"] in region_names
+            for s in r["region_sign"]]
+
+
+def get_region_clone_uuid_map(config, region_sign_list):
     region_clone_uuid_map = {}
     if config.clone_instances:
         region_clone_uuid_map = {
@@ -67,35 +179,121 @@ def try_to_create_instances():
             logger.info(f"这些区域没有指定要克隆的实例：({non_uuid_region_signs})，创建实例时将不会克隆。"
                         f" These regions do not specify an instance to be cloned: ({non_uuid_region_signs}) "
                         f"and will not be cloned when the instance is created.")
-    logger.debug(f"region_clone_uuid_map: {region_clone_uuid_map!r}")
-    logger.debug(f"region_sign_list: {region_sign_list!r}")
+    return region_clone_uuid_map
+
+
+def filter_scan_targets(region_list, idle_gpus, gpu_idle_num):
+    """
+    根据各地区汇总的空闲数量，筛选出可能有满足 gpu_idle_num 的机器的地区和显卡型号。
+    :param idle_gpus: 参见 autodl_client.get_region_idle_gpus
+    :return: (region_sign_list, gpu_type_names)
+    """
+    region_names = set()
+    gpu_type_names = []
+    for region_name, gpu_types in idle_gpus.items():
+        for gpu_type, idle_gpu_num in gpu_types.items():
+            if idle_gpu_num >= gpu_idle_num:
+                region_names.add(region_name)
+                if gpu_type not in gpu_type_names:
+                    gpu_type_names.append(gpu_type)
+    return get_region_sign_list(region_list, region_names), gpu_type_names
+
+
+def record_idle_gpus(idle_gpus):
+    """
+    :param idle_gpus: 参见 autodl_client.get_region_idle_gpus
+    """
+    _, state = hunt_events.snapshot()
+    merged_idle_gpus = state.get("idle_gpus") or {}
+    for region_name, gpu_types in idle_gpus.items():
+        merged_idle_gpus.setdefault(region_name, {}).update(gpu_types)
+        for gpu_type, idle_gpu_num in gpu_types.items():
+            metrics.set("hunter_idle_gpus", idle_gpu_num, region=region_name, gpu_type=gpu_type)
+    hunt_events.publish("idle_gpus", changed_only=True, idle_gpus=merged_idle_gpus)
+
+
+def record_region_idle_gpus(region_list):
+    """
+    记录 RegionList 本次重新获取到的空闲数量，使用缓存时不记录，避免旧数据覆盖 get_region_idle_gpus 的最新结果。
+    """
+    if region_list.fresh_list:
+        record_idle_gpus({
+            r["region_name"]: {g["gpu_type"]: g["idle_gpu_num"] for g in r["gpu_types"]}
+            for r in region_list.fresh_list
+        })
+
+
+def record_machines_matched(machines_matched):
+    metrics.set("hunter_machines_matched", machines_matched)
+    hunt_events.publish("machines_matched", changed_only=True, machines_matched=machines_matched)
+
+
+def try_to_create_instances(scheduler=None):
+    from gpuhunter.autodl_client import (
+        instance_cache, resolve_image_info, get_running_instances, get_region_idle_gpus,
+        get_available_machines, iter_available_machines
+    )
+    from gpuhunter.data_object import Config, RegionList
+    from gpuhunter.gpu_history import get_gpu_history
+
+    # 加载数据和配置
+    config = Config().load()
+    with metrics.timer("hunter_phase_seconds", phase="region_refresh"):
+        region_list = RegionList().refresh(history=get_gpu_history(config))
+    record_region_idle_gpus(region_list)
+    region_sign_list = get_region_sign_list(region_list, config.region_names)
+    debug_payload(logger, "config", config.to_dict())
+    debug_payload(logger, "region_list.list", region_list.list)
+    # 自适应扫描和两阶段扫描都需要先查询目标显卡的空闲数量
+    idle_gpus = None
+    if config.two_stage_scan or scheduler is not None and scheduler.adaptive:
+        with metrics.timer("hunter_phase_seconds", phase="idle_probe"):
+            idle_gpus = get_region_idle_gpus(region_list, config.region_names, config.gpu_type_names)
+        logger.debug("idle_gpus: %r", idle_gpus)
+        record_idle_gpus(idle_gpus)
+        if scheduler is not None:
+            scheduler.observe(idle_gpus)
+
+    # 如果有克隆目标，确保使用同区域的机器
+    region_clone_uuid_map = get_region_clone_uuid_map(config, region_sign_list)
+    logger.debug("region_clone_uuid_map: %r", region_clone_uuid_map)
+    logger.debug("region_sign_list: %r", region_sign_list)
     logger.info(f"尝试创建 {config.instance_num} 个实例..."
                 f" Try to create {config.instance_num} instances...")
     # 获取镜像
-    image_info = resolve_image_info(
-        base_image_labels=config.base_image_labels,
-        shared_image_keyword=config.shared_image_keyword,
-        shared_image_username_keyword=config.shared_image_username_keyword,
-        shared_image_version=config.shared_image_version,
-        private_image_uuid=config.private_image_uuid,
-        private_image_name=config.private_image_name
-    )
-    logger.debug(f"image_info: {image_info!r}")
-    # 获取当前运行的实例
-    instances = get_running_instances(
-        region_names=config.region_names,
-        gpu_type_names=config.gpu_type_names,
-        image=image_info["image"],
-        private_image_uuid=image_info["private_image_uuid"],
-        reproduction_uuid=image_info["reproduction_uuid"],
-        reproduction_id=image_info["reproduction_id"]
-    )
+    with metrics.timer("hunter_phase_seconds", phase="image_resolve"):
+        image_info = resolve_image_info(
+            base_image_labels=config.base_image_labels,
+            shared_image_keyword=config.shared_image_keyword,
+            shared_image_username_keyword=config.shared_image_username_keyword,
+            shared_image_version=config.shared_image_version,
+            private_image_uuid=config.private_image_uuid,
+            private_image_name=config.private_image_name
+        )
+    logger.debug("image_info: %r", image_info)
+    # 获取当前运行的实例（优先使用缓存）
+    def find_running_instances(force=False):
+        with metrics.timer("hunter_phase_seconds", phase="running_instances"):
+            return get_running_instances(
+                region_names=config.region_names,
+                gpu_type_names=config.gpu_type_names,
+                image=image_info["image"],
+                private_image_uuid=image_info["private_image_uuid"],
+                reproduction_uuid=image_info["reproduction_uuid"],
+                reproduction_id=image_info["reproduction_id"],
+                instances=instance_cache.get_instances(config.instance_refresh_seconds, force=force),
+            )
+
+    instances = find_running_instances()
+    if len(instances) >= config.instance_num:
+        # 完成之前，使用最新的实例列表再确认一次
+        instances = find_running_instances(force=True)
     if len(instances) > 0:
         logger.info(f"{len(instances)} 个符合要求的实例已经在运行。"
                     f" {len(instances)} requested instances are running.")
     instance_to_create_num = max(0, config.instance_num - len(instances))
-    logger.debug(f"instances: {instances!r}")
-    logger.debug(f"instance_to_create_num: {instance_to_create_num!r}")
+    debug_payload(logger, "instances", instances)
+    logger.debug("instance_to_create_num: %r", instance_to_create_num)
     # 检查是否需要创建实例
     if instance_to_create_num == 0:
         # 如果没有，就立刻完成
@@ -103,16 +301,43 @@ def try_to_create_instances():
         return True
     else:
         # 如果需要，就创建实例
-        # 寻找符合要求的机器
-        machines = get_available_machines(
-            region_sign_list,
-            config.gpu_type_names,
-            gpu_idle_num=config.gpu_idle_num,
-            count=config.instance_num,
-            min_expand_data_disk=config.expand_data_disk,
-        )
+        created_instance_names = []
+        scan_region_sign_list, scan_gpu_type_names = region_sign_list, config.gpu_type_names
+        if config.two_stage_scan:
+            # 两阶段扫描：只在空闲数量足够的地区和显卡型号中获取机器列表
+            scan_region_sign_list, scan_gpu_type_names = filter_scan_targets(
+                region_list, idle_gpus, config.gpu_idle_num
+            )
+            logger.debug("scan_region_sign_list: %r", scan_region_sign_list)
+            logger.debug("scan_gpu_type_names: %r", scan_gpu_type_names)
+        if config.two_stage_scan and not scan_region_sign_list:
+            machines = []
+        elif config.create_streaming:
+            # 边获取机器列表边创建实例，找到一台符合要求的机器就立即下单
+            with metrics.timer("hunter_phase_seconds", phase="machine_list_create"):
+                machines, created_instance_names = stream_create_instances(
+                    iter_available_machines(
+                        scan_region_sign_list,
+                        scan_gpu_type_names,
+                        gpu_idle_num=config.gpu_idle_num,
+                        min_expand_data_disk=config.expand_data_disk,
+                    ),
+                    instance_to_create_num, config, image_info, region_clone_uuid_map
+                )
+        else:
+            # 寻找符合要求的机器
+            with metrics.timer("hunter_phase_seconds", phase="machine_list"):
+                machines = get_available_machines(
+                    scan_region_sign_list,
+                    scan_gpu_type_names,
+                    gpu_idle_num=config.gpu_idle_num,
+                    count=config.instance_num,
+                    min_expand_data_disk=config.expand_data_disk,
+                    order_by=config.machine_order_by,
+                )
         # 确保机器的数据盘扩容量足够
-        logger.debug(f"machines: {machines!r}")
+        debug_payload(logger, "machines", machines)
+        record_machines_matched(len(machines))
         # 检查是否有可用的机器
         if len(machines) == 0:
             # 如果没有就跳过
@@ -120,48 +345,22 @@ def try_to_create_instances():
                         f" No available machine.")
         else:
             # 如果有符合要求的机器就创建实例
-            created_instance_names = []
-            for machine in machines[:instance_to_create_num]:
-                try:
-                    # 创建实例
-                    instance_uuid = autodl_client.create_instance(
-                        machine["machine_id"],
-                        image_info["image"],
-                        private_image_uuid=image_info["private_image_uuid"],
-                        reproduction_uuid=image_info["reproduction_uuid"],
-                        reproduction_id=image_info["reproduction_id"],
-                        req_gpu_amount=config.gpu_idle_num,
-                        expand_data_disk=config.expand_data_disk,
-                        clone_instance_uuid=region_clone_uuid_map.get(machine["region_sign"]),
-                        copy_data_disk_after_clone=config.copy_data_disk_after_clone,
-                        keep_src_user_service_address_after_clone=config.keep_src_user_service_address_after_clone,
-                    )
-                    # 设置实例名称
-                    autodl_client.update_instance_name(instance_uuid, "🎁🐒")
-                    # 设置定时关机
-                    shutdown_at = None
-                    if config.shutdown_instance_after_hours:
-                        shutdown_at = datetime.now() + timedelta(hours=config.shutdown_instance_after_hours)
-                    elif config.shutdown_instance_today:
-                        shutdown_at = end_of_day(datetime.now())
-                    if shutdown_at:
-                        logger.debug(
-                            f"shutdown planned, instance_uuid: {instance_uuid!r}, shutdown_at: {shutdown_at!r}")
-                        autodl_client.update_instance_shutdown(instance_uuid, shutdown_at)
-                    instance_name = f'{machine["region_name"]} / {machine["machine_alias"]}' \
-                                    f' ({machine["gpu_name"]}, {instance_uuid})'
-                    logger.info(f"已创建实例：{instance_name}。"
-                                f" Instance has been created: {instance_name}.")
-                    created_instance_names.append(instance_name)
-                except FailedError:
-                    logger.error(f'{machine["region_name"]} {machine["machine_alias"]} {machine["gpu_name"]}'
-                                 f' ({machine["machine_id"]})')
-                    logger.error(f"使用以上机器创建实例时发生错误，跳过并继续..."
-                                 f" An error occurred while creating the instance with the above machine,"
-                                 f" skip and continue...")
-            logger.debug(f"created_instance_names: {created_instance_names!r}")
+            if not config.create_streaming:
+                with metrics.timer("hunter_phase_seconds", phase="create"):
+                    created_instance_names = create_instances(machines[:instance_to_create_num], config,
+                                                              image_info, region_clone_uuid_map)
+            logger.debug("created_instance_names: %r", created_instance_names)
             # 检查是否完成
             if len(created_instance_names) == instance_to_create_num:
+                # 之前计入的实例可能来自旧的缓存，已经被关机了，完成之前使用最新的实例列表再确认一次。
+                # 刚创建的实例可能还不在实例列表中，直接计入
+                running_uuids = {i["uuid"] for i in find_running_instances(force=True)}
+                running_instance_num = len([i for i in instances if i["uuid"] in running_uuids]) \
+                    + len(created_instance_names)
+                if running_instance_num < config.instance_num:
+                    logger.info(f"只有 {running_instance_num} 个符合要求的实例在运行，继续蹲守。"
+                                f" Only {running_instance_num} requested instances are running, keep hunting.")
+                    return False
                 # 创建的实例达到要求的数量后，完成
                 logger.info(f"{instance_to_create_num} 个实例创建完毕。"
                             f" {instance_to_create_num} requested instances are created.")
@@ -170,21 +369,80 @@ def try_to_create_instances():
     return False
 
 
+def record_connection_stats():
+    """
+    记录每个域名的请求数和新建的连接数，reused 接近 requests 说明连接被复用，没有重复握手。
+    """
+    from gpuhunter.autodl_client import autodl_client
+    stats = autodl_client.get_connection_stats()
+    for host, host_stats in stats.items():
+        metrics.set("autodl_http_requests", host_stats["requests"], host=host)
+        metrics.set("autodl_http_connections", host_stats["connections"], host=host)
+        metrics.set("autodl_http_reused_requests", host_stats["reused"], host=host)
+    logger.debug("connection stats: %r", stats)
+
+
+def run_scan_cycle(cycle, *args):
+    """
+    执行一轮扫描，网络请求失败时只记录日志，视为本轮未完成，等待下一轮重试。
+    """
+    metrics.inc("hunter_scans_total")
+    hunt_events.publish("scan_started", scanning=True)
+    started_at = time.time()
+    finished, error = False, None
+    try:
+        with metrics.timer("hunter_scan_seconds"):
+            finished = cycle(*args)
+        return finished
+    except RequestException as e:
+        error = repr(e)
+        metrics.inc("hunter_scan_errors_total")
+        logger.warning(f"扫描时网络请求失败，稍后重试：{e!r}。"
+                       f" Network request failed while scanning, will retry later: {e!r}.")
+        return False
+    finally:
+        record_connection_stats()
+        hunt_events.publish(
+            "scan_finished",
+            scanning=False, finished=finished, last_scan_at=started_at,
+            last_scan_seconds=time.time() - started_at, last_scan_error=error,
+        )
+
+
 def get_help():
     return "开始蹲守。 Start waiting."
 
 
 def add_arguments(parser):
-    pass
+    parser.add_argument("--metrics-port", type=int, default=None,
+                        help="在此端口提供 Prometheus 指标。 Serve Prometheus metrics on this port.")
+    parser.add_argument("--metrics-host", default="127.0.0.1",
+                        help="指标服务监听的地址。 Address for the metrics server to listen on.")
+
+
+def start_metrics_server(metrics_port=None, metrics_host="127.0.0.1"):
+    from gpuhunter.utils.metrics import start_http_server
+    metrics.set("hunter_started_at_seconds", time.time())
+    if metrics_port is not None:
+        start_http_server(metrics_port, metrics_host)
+        logger.info(f"指标服务已启动：http://{metrics_host}:{metrics_port}/metrics。"
+                    f" Metrics server started: http://{metrics_host}:{metrics_port}/metrics.")
 
 
-def main():
+def main(metrics_port=None, metrics_host="127.0.0.1"):
+    from gpuhunter.autodl_client import autodl_client, instance_cache
     from gpuhunter.data_object import Config
+    from gpuhunter.scheduler import ScanScheduler
+    start_metrics_server(metrics_port, metrics_host)
     config = Config().load()
+    instance_cache.invalidate()
+    scheduler = ScanScheduler.from_config(config)
     while True:
-        if not try_to_create_instances():
-            # 否则等待指定时间后重试
-            logger.debug(f"wait for next retry, config.retry_interval_seconds: {config.retry_interval_seconds!r}")
-            time.sleep(config.retry_interval_seconds)
+        request_count = autodl_client.request_count
+        if not run_scan_cycle(try_to_create_instances, scheduler):
+            # 否则等待一段时间后重试
+            interval, reason = scheduler.next_interval(autodl_client.request_count - request_count)
+            logger.debug("wait for next retry, interval: %r, reason: %s", interval, reason)
+            time.sleep(interval)
         else:
             break
@@ -1,12 +1,76 @@
 import json
 import os
+import pickle
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import contextmanager, nullcontext
 from datetime import datetime
+from stat import S_IMODE
 
 from gpuhunter.utils.helpers import snake_case
-from main import DATA_DIR
+from main import DATA_DIR, logger
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# 数据文件的读取缓存：{filename: (inode, mtime_ns, size, 文件内容, pickle 后的数据)}，文件没有变化时不必重新解析 JSON。
+# atomic_write 每次都会换成新的 inode，mtime 精度较低的文件系统上同样大小的改写也能发现
+_file_cache = {}
+_file_cache_lock = threading.Lock()
+
+
+@contextmanager
+def file_lock(filename):
+    """
+    使用 filename.lock 作为进程间的写锁，不支持 fcntl 的系统（Windows）上不加锁。
+    """
+    if fcntl is None:
+        yield
+        return
+    with open(f"{filename}.lock", "w") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def atomic_write(filename, content):
+    """
+    先写入同目录下的临时文件再改名，读取的一方不会读到写了一半的文件。已有文件的权限保持不变。
+    :param content: str 或 bytes
+    """
+    try:
+        mode = S_IMODE(os.stat(filename).st_mode)
+    except FileNotFoundError:
+        mode = 0o644
+    fd, temp_filename = tempfile.mkstemp(dir=os.path.dirname(filename),
+                                         prefix=f".{os.path.basename(filename)}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb" if isinstance(content, bytes) else "w",
+                       **({} if isinstance(content, bytes) else {"encoding": "utf-8"})) as f:
+            f.write(content)
+        os.chmod(temp_filename, mode)
+        os.replace(temp_filename, filename)
+    except BaseException:
+        if os.path.exists(temp_filename):
+            os.remove(temp_filename)
+        raise
 
 
 class DataObjectMixin:
+    # 内存缓存的有效期（秒），None 表示不缓存，由子类设置
+    ttl_seconds = None
+    _cache = {}
+    # 保存时的缩进，None 表示紧凑格式；需要手动编辑的文件可以设置为 2
+    json_indent = None
+    # 保存时是否加文件锁，防止多个进程同时写入
+    use_file_lock = True
+
     def __init__(self, **kwargs):
         self.__dict__.update(kwargs)
 
@@ -14,42 +78,127 @@ class DataObjectMixin:
     def data_file(self):
         return f"{snake_case(self.__class__.__name__)}.json"
 
+    @property
+    def data_path(self):
+        return os.path.join(DATA_DIR, self.data_file)
+
     @property
     def modified_time(self):
-        filename = os.path.join(DATA_DIR, self.data_file)
+        filename = self.data_path
         if os.path.exists(filename):
             return datetime.fromtimestamp(os.path.getmtime(filename))
         else:
             return None
 
     def to_dict(self):
-        return self.__dict__
+        # 下划线开头的属性是运行时的缓存，不保存
+        return {k: v for k, v in self.__dict__.items() if not k.startswith("_")}
+
+    def dumps(self):
+        if self.json_indent is None:
+            return json.dumps(self.to_dict(), ensure_ascii=False, separators=(",", ":"))
+        return json.dumps(self.to_dict(), ensure_ascii=False, indent=self.json_indent)
 
     def save(self):
-        with open(os.path.join(DATA_DIR, self.data_file), "w", encoding="utf-8") as f:
-            json.dump(self.to_dict(), f, ensure_ascii=False, indent=2)
-            f.close()
+        self.write()
         return self
 
+    def write(self):
+        """
+        先写入临时文件再改名，读取的一方不会读到写了一半的文件；内容没有变化时不写入。
+        :return: 是否写入了文件
+        """
+        filename = self.data_path
+        content = self.dumps()
+        with file_lock(filename) if self.use_file_lock else nullcontext():
+            if (cached := self.get_file_cache(filename)) and cached[3] == content:
+                return False
+            atomic_write(filename, content)
+            self.set_file_cache(filename, os.stat(filename), content, self.to_dict())
+        return True
+
+    def touch(self):
+        filename = self.data_path
+        with file_lock(filename) if self.use_file_lock else nullcontext():
+            cached = self.get_file_cache(filename)
+            os.utime(filename)
+            if cached is not None:
+                self.set_file_cache(filename, os.stat(filename), cached[3], pickle.loads(cached[4]))
+
+    @staticmethod
+    def get_file_cache(filename, stat=None):
+        """
+        :return: 文件没有变化时返回缓存的 (inode, mtime_ns, size, 文件内容, pickle 后的数据)，否则返回 None
+        """
+        try:
+            stat = stat or os.stat(filename)
+        except FileNotFoundError:
+            return None
+        with _file_cache_lock:
+            cached = _file_cache.get(filename)
+        if cached and cached[:3] == (stat.st_ino, stat.st_mtime_ns, stat.st_size):
+            return cached
+        return None
+
+    @staticmethod
+    def set_file_cache(filename, stat, content, data):
+        with _file_cache_lock:
+            _file_cache[filename] = (stat.st_ino, stat.st_mtime_ns, stat.st_size, content, pickle.dumps(data))
+
     def load(self):
-        filename = os.path.join(DATA_DIR, self.data_file)
-        if os.path.exists(filename):
-            with open(filename, "r", encoding="utf-8") as f:
-                data = json.load(f)
-                self.__dict__.update(data)
-                f.close()
+        filename = self.data_path
+        try:
+            f = open(filename, "r", encoding="utf-8")
+        except FileNotFoundError:
+            return self
+        with f:
+            stat = os.fstat(f.fileno())
+            if cached := self.get_file_cache(filename, stat):
+                data = pickle.loads(cached[4])
+            else:
+                content = f.read()
+                data = json.loads(content)
+                self.set_file_cache(filename, stat, content, data)
+        self.__dict__.update(data)
         return self
 
-    def update(self):
-        self.fetch()
-        self.save()
+    def update(self, **kwargs):
+        """
+        :param kwargs: 传给 fetch
+        """
+        self.fetch(**kwargs)
+        if not self.write():
+            # 数据没有变化，只更新文件的修改时间，表示数据仍然是新的
+            self.touch()
+        self._cache[self.__class__] = (time.time(), pickle.dumps(self.to_dict()))
         return self
 
+    def refresh(self, **kwargs):
+        """
+        在 ttl_seconds 有效期内直接使用内存（或磁盘）中的数据，过期后才重新 fetch 并保存。
+        :param kwargs: 传给 fetch
+        """
+        if self.ttl_seconds is None:
+            return self.update(**kwargs)
+        if cached := self._cache.get(self.__class__):
+            cached_at, data = cached
+            if time.time() - cached_at < self.ttl_seconds:
+                self.__dict__.update(pickle.loads(data))
+                return self
+        if (modified_time := self.modified_time) \
+                and (datetime.now() - modified_time).total_seconds() < self.ttl_seconds:
+            self.load()
+            self._cache[self.__class__] = (modified_time.timestamp(), pickle.dumps(self.to_dict()))
+            return self
+        return self.update(**kwargs)
+
     def fetch(self, **kwargs):
         pass
 
 
 class Config(DataObjectMixin):
+    # 高级设置需要手动编辑，保存为带缩进的格式
+    json_indent = 2
     token = ""
     region_names = []
     gpu_type_names = []
@@ -70,6 +219,26 @@ class Config(DataObjectMixin):
     shutdown_instance_today = True
     shutdown_hunter_after_finished = False
     retry_interval_seconds = 30
+    adaptive_scan = False
+    min_retry_interval_seconds = 5
+    max_retry_interval_seconds = 300
+    request_budget_per_minute = 60
+    list_page_workers = 1
+    region_fetch_workers = 8
+    region_fetch_timeout_seconds = 15
+    rate_limit_per_second = 10
+    rate_limit_burst = 20
+    create_concurrently = False
+    create_streaming = False
+    machine_order_by = []
+    two_stage_scan = False
+    instance_refresh_seconds = 300
+    log_payload_sample_rate = 0.1
+    log_payload_max_length = 2000
+    gpu_history_enabled = True
+    gpu_history_retention_days = 30
+    gpu_history_raw_days = 2
+    gpu_history_bucket_seconds = 3600
     mail_notify = False
     mail_receipt = ""
     mail_sender = ""
@@ -80,44 +249,170 @@ class Config(DataObjectMixin):
 
 
 class RegionList(DataObjectMixin):
+    ttl_seconds = 600
     list = []
+    # (计算时的 list, get_matrix 的结果)，list 被替换后重新计算
+    _matrix = None
+    # 本次 fetch 实际获取到的地区数据，不包括超时沿用的旧数据；refresh 使用缓存时为 None
+    _fresh_list = None
 
-    def fetch(self):
+    def fetch(self, workers=None, timeout_seconds=None, history=None):
+        """
+        :param workers: 并发请求数，默认为 Config.region_fetch_workers
+        :param timeout_seconds: 等待所有地区返回的时间，默认为 Config.region_fetch_timeout_seconds
+        :param history: GpuHistory，不为 None 时把本次获取到的数据追加到历史记录中，参见 gpu_history.get_gpu_history
+        """
         from gpuhunter.autodl_client import autodl_client
+        workers = workers or autodl_client.region_fetch_workers
+        timeout_seconds = timeout_seconds or autodl_client.region_fetch_timeout_seconds
+        # 超时或出错的地区沿用上一次的统计数据
+        last_gpu_types = {
+            r["region_name"]: r["gpu_types"]
+            for r in (self.list or RegionList().load().list)
+        }
+        regions = autodl_client.get_regions()
+        executor = ThreadPoolExecutor(max_workers=max(1, min(workers, len(regions))))
+        futures = [executor.submit(autodl_client.get_region_gpu_types, r["region_sign"]) for r in regions]
+        wait(futures, timeout=timeout_seconds)
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=False)
         self.list = []
-        for r in autodl_client.get_regions():
-            self.list.append({
-                **r,
-                "gpu_types": [
+        fresh_region_list = []
+        errors = []
+        for r, future in zip(regions, futures):
+            if future.done() and not future.cancelled() and (e := future.exception()) is not None:
+                logger.warning(f"获取地区 GPU 数据失败，沿用上次的数据：{r['region_name']}，{e!r}。"
+                               f" Failed to fetch GPU types, keep the last known stats: {r['region_name']}, {e!r}.")
+                errors.append(e)
+                gpu_types = last_gpu_types.get(r["region_name"], [])
+            elif future.done() and not future.cancelled():
+                gpu_types = [
                     {
                         "gpu_type": next(iter(g.keys())),
                         **next(iter(g.values())),
                     }
-                    for g in autodl_client.get_region_gpu_types(r["region_sign"])
+                    for g in future.result()
                 ]
+                fresh_region_list.append({"region_name": r["region_name"], "gpu_types": gpu_types})
+            else:
+                logger.warning(f"获取地区 GPU 数据超时，沿用上次的数据：{r['region_name']}。"
+                               f" Fetching GPU types timed out, keep the last known stats: {r['region_name']}.")
+                gpu_types = last_gpu_types.get(r["region_name"], [])
+            self.list.append({
+                **r,
+                "gpu_types": gpu_types,
             })
+        if errors and len(errors) == len(regions):
+            # 所有地区都出错（例如 Token 无效）时不能当作正常结果
+            raise errors[0]
+        self._fresh_list = fresh_region_list
+        # 记录到历史数据中，超时沿用的旧数据不记录
+        if history is not None and fresh_region_list:
+            try:
+                history.append(fresh_region_list)
+            except OSError as e:
+                logger.warning(f"保存 GPU 历史数据失败：{e!r}。"
+                               f" Failed to save GPU history: {e!r}.")
+
+    @property
+    def fresh_list(self):
+        """
+        :return: 本次 refresh 重新获取到的地区数据，使用缓存时为空列表
+        """
+        return self._fresh_list or []
+
+    def get_matrix(self):
+        """
+        地区 × 显卡型号的 GPU 数量矩阵，同一份 list 只计算一次。
+        :return: (region_names, gpu_types, {
+          "西北B区": {
+            "RTX 4090": {"idle_gpu_num": 3, "total_gpu_num": 2686}
+          }
+        })
+        """
+        if self._matrix is not None and self._matrix[0] is self.list:
+            return self._matrix[1]
+        region_names = []
+        gpu_types = {}
+        cells = {}
+        for r in self.list:
+            if r["region_name"] not in cells:
+                region_names.append(r["region_name"])
+            row = cells.setdefault(r["region_name"], {})
+            for g in r["gpu_types"]:
+                gpu_types.setdefault(g["gpu_type"], None)
+                cell = row.setdefault(g["gpu_type"], {"idle_gpu_num": 0, "total_gpu_num": 0})
+                cell["idle_gpu_num"] += g["idle_gpu_num"]
+                cell["total_gpu_num"] += g["total_gpu_num"]
+        matrix = (region_names, list(gpu_types), cells)
+        self._matrix = (self.list, matrix)
+        return matrix
+
+    def get_region_gpu_stats(self, region_name, gpu_type):
+        """
+        :return: {"idle_gpu_num": 3, "total_gpu_num": 2686}，没有该显卡时都为 0
+        """
+        _, _, cells = self.get_matrix()
+        return {**cells.get(region_name, {}).get(gpu_type, {"idle_gpu_num": 0, "total_gpu_num": 0})}
 
     def get_gpu_type_names(self):
-        return [s["gpu_type"] for s in self.get_gpu_stats()]
+        return list(self.get_matrix()[1])
 
     def get_gpu_stats(self, region_names=None, gpu_types=None):
-        gpu_stats = []
-        for r in [r for r in self.list if not region_names or r["region_name"] in region_names]:
-            for g in [g for g in r["gpu_types"] if not gpu_types or g["gpu_type"] in gpu_types]:
-                if existed := next((e for e in gpu_stats if e["gpu_type"] == g["gpu_type"]), None):
-                    existed["idle_gpu_num"] += g["idle_gpu_num"]
-                    existed["total_gpu_num"] += g["total_gpu_num"]
-                else:
-                    gpu_stats.append({**g})
-        return gpu_stats
+        all_region_names, _, cells = self.get_matrix()
+        gpu_stats = {}
+        for region_name in all_region_names:
+            if region_names and region_name not in region_names:
+                continue
+            for gpu_type, cell in cells[region_name].items():
+                if gpu_types and gpu_type not in gpu_types:
+                    continue
+                stats = gpu_stats.setdefault(gpu_type, {"gpu_type": gpu_type, "idle_gpu_num": 0, "total_gpu_num": 0})
+                stats["idle_gpu_num"] += cell["idle_gpu_num"]
+                stats["total_gpu_num"] += cell["total_gpu_num"]
+        return list(gpu_stats.values())
 
     def get_region_stats(self, gpu_types=None, region_names=None):
+        all_region_names, _, cells = self.get_matrix()
         region_stats = []
-        for r in [r for r in self.list if not region_names or r["region_name"] in region_names]:
-            filtered = [g for g in r["gpu_types"] if not gpu_types or g["gpu_type"] in gpu_types]
+        for region_name in all_region_names:
+            if region_names and region_name not in region_names:
+                continue
+            filtered = [c for gpu_type, c in cells[region_name].items() if not gpu_types or gpu_type in gpu_types]
             region_stats.append({
-                "region_name": r["region_name"],
-                "idle_gpu_num": sum(g["idle_gpu_num"] for g in filtered),
-                "total_gpu_num": sum(g["total_gpu_num"] for g in filtered),
+                "region_name": region_name,
+                "idle_gpu_num": sum(c["idle_gpu_num"] for c in filtered),
+                "total_gpu_num": sum(c["total_gpu_num"] for c in filtered),
             })
         return region_stats
+
+
+class HuntList(DataObjectMixin):
+    """
+    多个蹲守任务，list 中的每一项是对 Config 的覆盖设置，另外可以指定 name 和 priority（数字越大越优先），
+    hunt_list.json 例如：
+    {
+      "list": [
+        {
+          "name": "training",
+          "priority": 10,
+          "gpu_type_names": ["RTX 4090"],
+          "region_names": ["西北B区"],
+          "instance_num": 2
+        }
+      ]
+    }
+    """
+    # 需要手动编辑，保存为带缩进的格式
+    json_indent = 2
+    list = []
+
+
+class GpuHistoryIndex(DataObjectMixin):
+    """
+    GPU 历史数据中的序列名称，series 中的下标即为记录中的序列编号，例如：[["西北B区", "RTX 4090"]]
+    """
+    series = []
+    # 上次降采样的时间戳
+    compacted_at = 0
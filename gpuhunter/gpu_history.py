@@ -0,0 +1,241 @@
+import os
+import struct
+import threading
+import time
+
+from gpuhunter.data_object import GpuHistoryIndex, atomic_write, file_lock
+from main import DATA_DIR, logger
+
+# 每条记录：时间戳（秒）、序列编号（地区 + 显卡型号，见 GpuHistoryIndex.series）、采样次数、空闲数量的最大值、
+# 空闲数量之和、空闲数量大于 0 的采样次数、总数量。原始记录的采样次数为 1，降采样后的记录汇总一段时间内的所有采样
+RECORD = struct.Struct("<IHIIIII")
+
+
+class GpuHistory:
+    """
+    各地区各显卡型号 GPU 数量的历史记录，按时间顺序追加到定长记录的二进制文件中，地区和显卡型号的名称保存在
+    GpuHistoryIndex 中。超过 raw_days 天的记录按 bucket_seconds 降采样（每段时间合并为一条，保留采样次数、
+    最大值、总和和有空闲的次数，汇总时仍按采样加权），超过 retention_days 天的记录删除。
+    """
+
+    def __init__(self, filename=None, retention_days=30, raw_days=2, bucket_seconds=3600):
+        self.filename = filename or os.path.join(DATA_DIR, "gpu_history_v2.bin")
+        self.retention_days = retention_days
+        self.raw_days = raw_days
+        self.bucket_seconds = bucket_seconds
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(
+            retention_days=config.gpu_history_retention_days,
+            raw_days=config.gpu_history_raw_days,
+            bucket_seconds=config.gpu_history_bucket_seconds,
+        )
+
+    def append(self, region_list, timestamp=None):
+        """
+        追加记录，需要降采样时在后台线程中进行，不阻塞调用方。
+        :param region_list: RegionList.list 格式的列表
+        :param timestamp: 默认为当前时间，早于最后一条记录时使用最后一条记录的时间，保证文件按时间排序
+        """
+        with file_lock(self.filename):
+            # 在锁内取时间，多个进程同时追加时也不会写入更早的记录
+            timestamp = max(int(timestamp or time.time()), self.last_timestamp())
+            index = GpuHistoryIndex().load()
+            series_ids = {tuple(s): i for i, s in enumerate(index.series)}
+            records = []
+            for r in region_list:
+                for g in r["gpu_types"]:
+                    key = (r["region_name"], g["gpu_type"])
+                    if key not in series_ids:
+                        series_ids[key] = len(index.series)
+                        index.series = index.series + [list(key)]
+                    idle_gpu_num = g["idle_gpu_num"]
+                    records.append(RECORD.pack(timestamp, series_ids[key], 1, idle_gpu_num, idle_gpu_num,
+                                               int(idle_gpu_num > 0), g["total_gpu_num"]))
+            # 先保存名称再写入记录，记录中的序列编号总能找到名称
+            index.save()
+            with open(self.filename, "ab") as f:
+                # 上次写入中断时会留下不完整的记录，先截掉，否则之后的记录都会错位
+                size = os.fstat(f.fileno()).st_size
+                if size % RECORD.size:
+                    f.truncate(size - size % RECORD.size)
+                f.write(b"".join(records))
+        if timestamp - index.compacted_at >= self.bucket_seconds:
+            threading.Thread(target=self.compact, name="gpu-history-compact", daemon=True).start()
+
+    def last_timestamp(self):
+        """
+        :return: 最后一条记录的时间戳，没有记录时为 0
+        """
+        try:
+            with open(self.filename, "rb") as f:
+                size = os.fstat(f.fileno()).st_size
+                if size < RECORD.size:
+                    return 0
+                f.seek(size - size % RECORD.size - RECORD.size)
+                return RECORD.unpack(f.read(RECORD.size))[0]
+        except FileNotFoundError:
+            return 0
+
+    def compact(self, now=None):
+        """
+        降采样和删除过期的记录，距离上次整理不足 bucket_seconds 时跳过。
+        """
+        with file_lock(self.filename):
+            now = int(now or time.time())
+            index = GpuHistoryIndex().load()
+            if now - index.compacted_at < self.bucket_seconds:
+                return
+            self._compact(index, now)
+
+    def _compact(self, index, now):
+        raw_after = now - self.raw_days * 86400
+        retain_after = now - self.retention_days * 86400
+        kept = []
+        # 降采样：{(序列编号, 时间段): kept 中的下标}
+        buckets = {}
+        for record in self.read_records():
+            timestamp, series_id, samples, idle_gpu_num_max, idle_gpu_num_sum, available_samples, total_gpu_num \
+                = record
+            if timestamp < retain_after:
+                continue
+            if timestamp >= raw_after:
+                kept.append(record)
+                continue
+            # 降采样后的记录使用时间段的起始时间，保证文件仍然按时间排序
+            bucket_start = timestamp - timestamp % self.bucket_seconds
+            key = (series_id, bucket_start)
+            if key not in buckets:
+                buckets[key] = len(kept)
+                kept.append((bucket_start, *record[1:]))
+            else:
+                _, _, last_samples, last_max, last_sum, last_available_samples, _ = kept[buckets[key]]
+                kept[buckets[key]] = (
+                    bucket_start, series_id, last_samples + samples, max(last_max, idle_gpu_num_max),
+                    last_sum + idle_gpu_num_sum, last_available_samples + available_samples, total_gpu_num,
+                )
+        atomic_write(self.filename, b"".join(RECORD.pack(*r) for r in kept))
+        index.compacted_at = now
+        index.save()
+        logger.debug("gpu history compacted, records: %d", len(kept))
+
+    def read_records(self, since=None):
+        """
+        :return: 按时间顺序的 (timestamp, series_id, samples, idle_gpu_num_max, idle_gpu_num_sum,
+            available_samples, total_gpu_num)
+        """
+        if not os.path.exists(self.filename):
+            return
+        with open(self.filename, "rb") as f:
+            count = os.fstat(f.fileno()).st_size // RECORD.size
+            start = 0
+            if since is not None:
+                # 二分查找第一条不早于 since 的记录
+                low, high = 0, count
+                while low < high:
+                    middle = (low + high) // 2
+                    f.seek(middle * RECORD.size)
+                    if RECORD.unpack(f.read(RECORD.size))[0] < since:
+                        low = middle + 1
+                    else:
+                        high = middle
+                start = low
+            f.seek(start * RECORD.size)
+            while chunk := f.read(RECORD.size * 4096):
+                yield from RECORD.iter_unpack(chunk[:len(chunk) - len(chunk) % RECORD.size])
+
+    def query(self, region_names=None, gpu_types=None, since=None, until=None):
+        """
+        例如最近 7 天西北B区的 RTX 4090：query(["西北B区"], ["RTX 4090"], since=time.time() - 7 * 86400)
+        :return: [
+          {
+            "time": 1700000000,
+            "region_name": "西北B区",
+            "gpu_type": "RTX 4090",
+            "samples": 1,
+            "idle_gpu_num_max": 3,
+            "idle_gpu_num_sum": 3,
+            "available_samples": 1,
+            "total_gpu_num": 2686
+          }
+        ]，原始记录的 samples 为 1，降采样后的记录汇总了 samples 次采样
+        """
+        series = GpuHistoryIndex().load().series
+        series_ids = {
+            i for i, (region_name, gpu_type) in enumerate(series)
+            if (not region_names or region_name in region_names) and (not gpu_types or gpu_type in gpu_types)
+        }
+        results = []
+        for record in self.read_records(since):
+            timestamp, series_id, samples, idle_gpu_num_max, idle_gpu_num_sum, available_samples, total_gpu_num \
+                = record
+            if until is not None and timestamp >= until:
+                break
+            if series_id in series_ids:
+                region_name, gpu_type = series[series_id]
+                results.append({
+                    "time": timestamp,
+                    "region_name": region_name,
+                    "gpu_type": gpu_type,
+                    "samples": samples,
+                    "idle_gpu_num_max": idle_gpu_num_max,
+                    "idle_gpu_num_sum": idle_gpu_num_sum,
+                    "available_samples": available_samples,
+                    "total_gpu_num": total_gpu_num,
+                })
+        return results
+
+    @staticmethod
+    def aggregate(records, bucket_seconds=3600):
+        """
+        把 query 的结果按地区、显卡型号和时间段汇总，平均值和比例按每条记录的采样次数加权。
+        :return: [
+          {
+            "time": 1699999200,
+            "region_name": "西北B区",
+            "gpu_type": "RTX 4090",
+            "samples": 12,
+            "idle_gpu_num_max": 5,
+            "idle_gpu_num_avg": 1.5,
+            "available_ratio": 0.75
+          }
+        ]，available_ratio 为空闲数量大于 0 的采样比例
+        """
+        buckets = {}
+        for r in records:
+            key = (r["region_name"], r["gpu_type"], r["time"] - r["time"] % bucket_seconds)
+            if (bucket := buckets.get(key)) is None:
+                bucket = buckets[key] = {
+                    "time": key[2],
+                    "region_name": key[0],
+                    "gpu_type": key[1],
+                    "samples": 0,
+                    "idle_gpu_num_max": 0,
+                    "idle_gpu_num_sum": 0,
+                    "available_samples": 0,
+                }
+            bucket["samples"] += r["samples"]
+            bucket["idle_gpu_num_max"] = max(bucket["idle_gpu_num_max"], r["idle_gpu_num_max"])
+            bucket["idle_gpu_num_sum"] += r["idle_gpu_num_sum"]
+            bucket["available_samples"] += r["available_samples"]
+        results = []
+        for bucket in buckets.values():
+            samples = bucket["samples"]
+            results.append({
+                "time": bucket["time"],
+                "region_name": bucket["region_name"],
+                "gpu_type": bucket["gpu_type"],
+                "samples": samples,
+                "idle_gpu_num_max": bucket["idle_gpu_num_max"],
+                "idle_gpu_num_avg": bucket["idle_gpu_num_sum"] / samples,
+                "available_ratio": bucket["available_samples"] / samples,
+            })
+        return sorted(results, key=lambda b: (b["time"], b["region_name"], b["gpu_type"]))
+
+
+def get_gpu_history(config):
+    """
+    :return: 开启了 gpu_history_enabled 时返回 GpuHistory，否则返回 None，用作 RegionList.fetch 的 history 参数
+    """
+    return GpuHistory.from_config(config) if config.gpu_history_enabled else None
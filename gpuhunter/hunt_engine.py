@@ -0,0 +1,212 @@
+from gpuhunter.autodl_client import (
+    instance_cache, resolve_image_info,
+    get_running_instances, get_available_machines, get_region_idle_gpus
+)
+from gpuhunter.commands.wait import (
+    after_finished, create_instances, get_region_sign_list, get_region_clone_uuid_map,
+    record_idle_gpus, record_region_idle_gpus, record_machines_matched
+)
+from gpuhunter.data_object import Config, RegionList, HuntList
+from gpuhunter.gpu_history import get_gpu_history
+from gpuhunter.machine_table import MachineTable
+from gpuhunter.utils.metrics import metrics
+from main import logger
+
+
+class Hunt:
+    def __init__(self, config, name="", priority=0):
+        self.config = config
+        self.name = name
+        self.priority = priority
+        self.finished = False
+        self.created_instance_names = []
+
+    @classmethod
+    def from_spec(cls, base_config, spec):
+        """
+        :param base_config: Config，提供 token、邮件等公共设置
+        :param spec: HuntList.list 中的一项
+        """
+        spec = dict(spec)
+        name = spec.pop("name", "")
+        priority = spec.pop("priority", 0)
+        config = Config(**{**base_config.to_dict(), **spec})
+        return cls(config, name=name or ",".join(config.gpu_type_names), priority=priority)
+
+    def __repr__(self):
+        return f"<Hunt {self.name!r} priority={self.priority}>"
+
+
+class MultiHuntEngine:
+    """
+    在一个进程中同时蹲守多个任务：每轮扫描只获取一次地区、运行中的实例和机器列表，
+    然后按优先级把机器分配给各个任务。
+    """
+
+    def __init__(self, hunts):
+        self.hunts = sorted(hunts, key=lambda h: h.priority, reverse=True)
+        for hunt in self.hunts:
+            if hunt.config.two_stage_scan or hunt.config.create_streaming:
+                logger.warning(f"[{hunt.name}] 同时蹲守多个任务时不支持 two_stage_scan 和 create_streaming，已忽略。"
+                               f" [{hunt.name}] two_stage_scan and create_streaming are not supported"
+                               f" when running multiple hunts, ignored.")
+
+    @classmethod
+    def from_data(cls):
+        config = Config().load()
+        hunt_list = HuntList().load()
+        return cls([Hunt.from_spec(config, spec) for spec in hunt_list.list])
+
+    @property
+    def active_hunts(self):
+        return [h for h in self.hunts if not h.finished]
+
+    def run_cycle(self, scheduler=None):
+        """
+        :return: 所有任务都完成时返回 True
+        """
+        hunts = self.active_hunts
+        if len(hunts) == 0:
+            return True
+        with metrics.timer("hunter_phase_seconds", phase="region_refresh"):
+            # 历史记录的设置是公共设置，所有任务都相同
+            region_list = RegionList().refresh(history=get_gpu_history(hunts[0].config))
+        record_region_idle_gpus(region_list)
+        if scheduler is not None and scheduler.adaptive:
+            idle_gpus = get_region_idle_gpus(
+                region_list,
+                {n for h in hunts for n in h.config.region_names},
+                {n for h in hunts for n in h.config.gpu_type_names},
+            )
+            record_idle_gpus(idle_gpus)
+            scheduler.observe(idle_gpus)
+        # 所有任务共用一次运行中实例的查询（优先使用缓存），完成之前再用最新的实例列表确认一次
+        max_age = hunts[0].config.instance_refresh_seconds
+        demands, satisfied_hunts = self.collect_demands(self.hunts, region_list, instance_cache.get_instances(max_age))
+        if satisfied_hunts:
+            demands, satisfied_hunts = self.collect_demands(
+                self.hunts, region_list, instance_cache.get_instances(max_age, force=True)
+            )
+        for hunt in satisfied_hunts:
+            self.finish(hunt)
+        if len(demands) == 0:
+            return self.check_finished()
+        # 所有任务共用一次机器列表的扫描
+        with metrics.timer("hunter_phase_seconds", phase="machine_list"):
+            table = MachineTable(get_available_machines(
+                sorted({s for _, _, signs, _, _ in demands for s in signs}),
+                sorted({n for h, _, _, _, _ in demands for n in h.config.gpu_type_names}),
+                gpu_idle_num=min(h.config.gpu_idle_num for h, _, _, _, _ in demands),
+                count=None,
+                min_expand_data_disk=min(h.config.expand_data_disk for h, _, _, _, _ in demands),
+            ))
+        logger.debug("machine table size: %d", len(table))
+        record_machines_matched(len(table))
+        if len(table) == 0:
+            logger.info(f"没有可用的 GPU 机器。"
+                        f" No available machine.")
+            return False
+        # 按优先级分配机器
+        assigned_machine_ids = set()
+        # [(hunt, 计入的实例列表, 本轮创建的实例数)]
+        created_hunts = []
+        for hunt, instance_to_create_num, region_sign_list, image_info, instances in demands:
+            config = hunt.config
+            candidates = table.rank(
+                table.select(
+                    region_signs=region_sign_list,
+                    gpu_names=config.gpu_type_names,
+                    gpu_idle_num=config.gpu_idle_num,
+                    min_expand_data_disk=config.expand_data_disk,
+                ),
+                order_by=config.machine_order_by,
+            )
+            machines = [r.data for r in candidates if r.machine_id not in assigned_machine_ids]
+            machines = machines[:instance_to_create_num]
+            if len(machines) == 0:
+                continue
+            assigned_machine_ids.update(m["machine_id"] for m in machines)
+            logger.info(f"[{hunt.name}] 尝试创建 {len(machines)} 个实例..."
+                        f" [{hunt.name}] Try to create {len(machines)} instances...")
+            with metrics.timer("hunter_phase_seconds", phase="create"):
+                created_instance_names = create_instances(
+                    machines, config, image_info, get_region_clone_uuid_map(config, region_sign_list)
+                )
+            hunt.created_instance_names.extend(created_instance_names)
+            if len(created_instance_names) == instance_to_create_num:
+                created_hunts.append((hunt, instances, len(created_instance_names)))
+        if created_hunts:
+            # 之前计入的实例可能来自旧的缓存，已经被关机了，完成之前使用最新的实例列表再确认一次。
+            # 刚创建的实例可能还不在实例列表中，直接计入
+            running_uuids = {i["uuid"] for i in instance_cache.get_instances(max_age, force=True)}
+            for hunt, instances, created_instance_num in created_hunts:
+                running_instance_num = len([i for i in instances if i["uuid"] in running_uuids]) + created_instance_num
+                if running_instance_num >= hunt.config.instance_num:
+                    self.finish(hunt)
+                else:
+                    logger.info(f"[{hunt.name}] 符合要求的实例数量不足，继续蹲守。"
+                                f" [{hunt.name}] Not enough requested instances are running, keep hunting.")
+        return self.check_finished()
+
+    @staticmethod
+    def collect_demands(hunts, region_list, running_instances):
+        """
+        每个运行中的实例只计入优先级最高的匹配任务，每个任务最多计入 instance_num 个实例。已完成的任务也参与计数，
+        它们的实例不会被算到优先级更低、要求相同的任务上，但不会再产生新的需求。
+        :param hunts: 所有任务，按优先级从高到低
+        :return: ([(hunt, 要创建的实例数, region_sign_list, image_info, 计入的实例列表)], 已经满足要求的未完成任务列表)
+        """
+        counted_uuids = set()
+        demands = []
+        satisfied_hunts = []
+        for hunt in hunts:
+            config = hunt.config
+            image_info = resolve_image_info(
+                base_image_labels=config.base_image_labels,
+                shared_image_keyword=config.shared_image_keyword,
+                shared_image_username_keyword=config.shared_image_username_keyword,
+                shared_image_version=config.shared_image_version,
+                private_image_uuid=config.private_image_uuid,
+                private_image_name=config.private_image_name
+            )
+            instances = [
+                i for i in get_running_instances(
+                    region_names=config.region_names,
+                    gpu_type_names=config.gpu_type_names,
+                    image=image_info["image"],
+                    private_image_uuid=image_info["private_image_uuid"],
+                    reproduction_uuid=image_info["reproduction_uuid"],
+                    reproduction_id=image_info["reproduction_id"],
+                    instances=running_instances,
+                )
+                if i["uuid"] not in counted_uuids
+            ]
+            # 每个任务最多计入 instance_num 个实例，多出的实例留给优先级更低的任务
+            instances = instances[:config.instance_num]
+            counted_uuids.update(i["uuid"] for i in instances)
+            if hunt.finished:
+                continue
+            instance_to_create_num = max(0, config.instance_num - len(instances))
+            logger.debug("hunt: %r, instances: %d, to create: %d", hunt, len(instances), instance_to_create_num)
+            if instance_to_create_num == 0:
+                satisfied_hunts.append(hunt)
+            else:
+                region_sign_list = get_region_sign_list(region_list, config.region_names)
+                demands.append((hunt, instance_to_create_num, region_sign_list, image_info, instances))
+        return demands, satisfied_hunts
+
+    def finish(self, hunt):
+        hunt.finished = True
+        logger.info(f"[{hunt.name}] 蹲守完成。 [{hunt.name}] Hunt finished.")
+        # 只有全部任务完成后才关闭 Hunter
+        shutdown_hunter_after_finished = hunt.config.shutdown_hunter_after_finished
+        hunt.config.shutdown_hunter_after_finished = False
+        after_finished(hunt.config, hunt.created_instance_names)
+        hunt.config.shutdown_hunter_after_finished = shutdown_hunter_after_finished
+
+    def check_finished(self):
+        if self.active_hunts:
+            return False
+        if any(h.config.shutdown_hunter_after_finished for h in self.hunts):
+            after_finished(Config(shutdown_hunter_after_finished=True, mail_notify=False))
+        return True
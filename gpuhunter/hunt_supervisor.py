@@ -0,0 +1,109 @@
+import threading
+import time
+
+from gpuhunter.utils.events import hunt_events
+from main import logger
+
+
+class HuntSupervisor:
+    """
+    在后台线程中运行蹲守循环，不占用 Gradio 的请求线程，刷新或关闭页面也不会中断蹲守。
+    同一时间只运行一个蹲守任务。
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.thread = None
+        self.stop_event = threading.Event()
+        self.started_at = None
+        self.finished = False
+        self.error = None
+
+    @property
+    def is_running(self):
+        return self.thread is not None and self.thread.is_alive() and not self.stop_event.is_set()
+
+    @property
+    def is_stopping(self):
+        """
+        已经请求停止，但线程还在完成当前这轮扫描
+        """
+        return self.thread is not None and self.thread.is_alive() and self.stop_event.is_set()
+
+    def start(self, cycle=None):
+        """
+        :param cycle: 每轮扫描调用的函数，默认为 try_to_create_instances
+        :return: 已经在运行或者正在停止时返回 False
+        """
+        if cycle is None:
+            from gpuhunter.commands.wait import try_to_create_instances
+            cycle = try_to_create_instances
+        with self.lock:
+            # 上一个任务正在停止时不等待它结束，避免阻塞请求线程
+            if self.is_running or self.is_stopping:
+                return False
+            self.stop_event.clear()
+            self.started_at = time.time()
+            self.finished = False
+            self.error = None
+            self.thread = threading.Thread(target=self.run, args=(cycle,), name="hunt-supervisor", daemon=True)
+            hunt_events.publish("hunt_started", reset_state=True, running=True, started_at=self.started_at)
+            self.thread.start()
+            return True
+
+    def stop(self):
+        """
+        请求停止蹲守，正在进行的这轮扫描完成后线程退出。
+        :return: 没有在运行时返回 False
+        """
+        with self.lock:
+            if not self.is_running:
+                return False
+            # 先发布 hunt_stopping 再唤醒线程，保证它在线程发布的 hunt_stopped 之前
+            hunt_events.publish("hunt_stopping", running=False, stopping=True)
+            self.stop_event.set()
+        logger.info(f"停止蹲守。 Hunting stopped.")
+        return True
+
+    def status(self):
+        return {
+            "running": self.is_running,
+            "stopping": self.is_stopping,
+            "started_at": self.started_at,
+            "finished": self.finished,
+            "error": self.error,
+        }
+
+    def run(self, cycle):
+        from gpuhunter.autodl_client import autodl_client, instance_cache
+        from gpuhunter.commands.wait import run_scan_cycle
+        from gpuhunter.data_object import Config
+        from gpuhunter.scheduler import ScanScheduler
+        try:
+            instance_cache.invalidate()
+            scheduler = ScanScheduler.from_config(Config().load())
+            while not self.stop_event.is_set():
+                request_count = autodl_client.request_count
+                if run_scan_cycle(cycle, scheduler):
+                    self.finished = True
+                    break
+                # 否则等待一段时间后重试
+                interval, reason = scheduler.next_interval(autodl_client.request_count - request_count)
+                logger.info(
+                    f"等待 {interval:.0f} 秒后重新扫描..."
+                    f" Next scanning will start after {interval:.0f} seconds ({reason})..."
+                )
+                hunt_events.publish("scan_scheduled", next_scan_at=time.time() + interval, next_scan_reason=reason)
+                self.stop_event.wait(interval)
+        except Exception as e:
+            self.error = repr(e)
+            logger.exception(e)
+            logger.error(f"蹲守意外中止。 Hunting aborted unexpectedly.")
+        finally:
+            if self.stop_event.is_set():
+                hunt_events.publish("hunt_stopped", stopping=False)
+            else:
+                hunt_events.publish("hunt_finished", running=False, stopping=False, error=self.error)
+
+
+hunt_supervisor = HuntSupervisor()
@@ -0,0 +1,110 @@
+import bisect
+from collections import defaultdict
+
+
+def parse_version(version):
+    """
+    :param version: "12.2"
+    :return: (12, 2)
+    """
+    try:
+        return tuple(int(v) for v in str(version).split("."))
+    except ValueError:
+        return ()
+
+
+class MachineRecord:
+    __slots__ = (
+        "machine_id", "machine_alias", "region_name", "region_sign", "gpu_name",
+        "gpu_idle_num", "gpu_order_num", "max_data_disk_expand_size",
+        "payg_price", "cpu_per_gpu", "mem_per_gpu", "highest_cuda_version",
+        "data",
+    )
+
+    def __init__(self, data):
+        self.machine_id = data["machine_id"]
+        self.machine_alias = data.get("machine_alias", "")
+        self.region_name = data.get("region_name", "")
+        self.region_sign = data["region_sign"]
+        self.gpu_name = data["gpu_name"]
+        self.gpu_idle_num = data.get("gpu_idle_num", 0)
+        self.gpu_order_num = data.get("gpu_order_num", 0)
+        self.max_data_disk_expand_size = data.get("max_data_disk_expand_size", 0)
+        self.payg_price = data.get("payg_price", 0)
+        self.cpu_per_gpu = data.get("cpu_per_gpu", 0)
+        self.mem_per_gpu = data.get("mem_per_gpu", 0)
+        self.highest_cuda_version = parse_version(data.get("highest_cuda_version", ""))
+        self.data = data
+
+    def __repr__(self):
+        return f"<MachineRecord {self.region_sign}/{self.machine_alias} {self.gpu_name} ({self.machine_id})>"
+
+
+class MachineTable:
+    """
+    list_machine 结果的内存表，按 region_sign、gpu_name 建索引，并维护按 payg_price 排序的索引，
+    用于在大量机器中快速筛选和排序候选机器。
+    """
+    ORDER_FIELDS = ("payg_price", "cpu_per_gpu", "mem_per_gpu", "highest_cuda_version",
+                    "gpu_idle_num", "max_data_disk_expand_size")
+
+    def __init__(self, machines=()):
+        self.records = []
+        self.by_region_sign = defaultdict(list)
+        self.by_gpu_name = defaultdict(list)
+        self.by_price = []
+        for m in machines:
+            self.add(m)
+
+    def __len__(self):
+        return len(self.records)
+
+    def add(self, machine):
+        record = machine if isinstance(machine, MachineRecord) else MachineRecord(machine)
+        index = len(self.records)
+        self.records.append(record)
+        self.by_region_sign[record.region_sign].append(index)
+        self.by_gpu_name[record.gpu_name].append(index)
+        bisect.insort(self.by_price, (record.payg_price, index))
+        return record
+
+    def select(self, region_signs=None, gpu_names=None, gpu_idle_num=1, min_expand_data_disk=0, max_price=None):
+        """
+        :return: 符合条件的 MachineRecord 列表（保持 API 返回的顺序）
+        """
+        indexes = None
+        if region_signs is not None:
+            indexes = {i for s in region_signs for i in self.by_region_sign.get(s, [])}
+        if gpu_names is not None:
+            gpu_indexes = {i for n in gpu_names for i in self.by_gpu_name.get(n, [])}
+            indexes = gpu_indexes if indexes is None else indexes & gpu_indexes
+        if max_price is not None:
+            end = bisect.bisect_right(self.by_price, (max_price, len(self.records)))
+            price_indexes = {i for _, i in self.by_price[:end]}
+            indexes = price_indexes if indexes is None else indexes & price_indexes
+        if indexes is None:
+            indexes = range(len(self.records))
+        return [
+            r for r in (self.records[i] for i in sorted(indexes))
+            if r.gpu_idle_num >= gpu_idle_num
+            and r.gpu_order_num >= gpu_idle_num
+            and r.max_data_disk_expand_size >= min_expand_data_disk
+        ]
+
+    def rank(self, records=None, order_by=None):
+        """
+        :param records: 要排序的 MachineRecord 列表，默认是全部机器
+        :param order_by: ["payg_price", "-cpu_per_gpu", "-mem_per_gpu", "-highest_cuda_version"]，
+            字段名前加 "-" 表示降序
+        """
+        if records is None and list(order_by or []) == ["payg_price"]:
+            return [self.records[i] for _, i in self.by_price]
+        records = list(self.records if records is None else records)
+        if not order_by:
+            return records
+        for field in reversed(order_by):
+            name = field.lstrip("-")
+            if name not in self.ORDER_FIELDS:
+                raise ValueError(f"Unsupported order field: {field!r}")
+            records.sort(key=lambda r: getattr(r, name), reverse=field.startswith("-"))
+        return records
@@ -0,0 +1,79 @@
+import math
+
+from main import logger
+
+
+class ScanScheduler:
+    """
+    决定两次扫描之间的等待时间。
+    关闭自适应时始终使用 retry_interval_seconds；开启后，目标显卡的空闲数量有变化时缩短到最小间隔，
+    长时间没有变化时按指数退避，同时保证每分钟的请求数不超过预算。
+    """
+
+    def __init__(self, retry_interval_seconds=30, adaptive=False, min_interval_seconds=5,
+                 max_interval_seconds=300, backoff=1.5, request_budget_per_minute=60):
+        self.retry_interval_seconds = retry_interval_seconds
+        self.adaptive = adaptive
+        self.min_interval_seconds = min_interval_seconds
+        self.max_interval_seconds = max_interval_seconds
+        self.backoff = backoff
+        self.request_budget_per_minute = request_budget_per_minute
+        self.idle_gpus = None
+        self.last_idle_gpus = None
+        self.quiet_cycles = 0
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(
+            retry_interval_seconds=config.retry_interval_seconds,
+            adaptive=config.adaptive_scan,
+            min_interval_seconds=config.min_retry_interval_seconds,
+            max_interval_seconds=config.max_retry_interval_seconds,
+            request_budget_per_minute=config.request_budget_per_minute,
+        )
+
+    @property
+    def max_backoff_exponent(self):
+        """
+        间隔达到 max_interval_seconds 需要的退避次数，之后不再增大指数，避免连续多天没有变化时浮点数溢出
+        """
+        if self.backoff <= 1:
+            return self.quiet_cycles
+        if self.retry_interval_seconds <= 0:
+            return 0
+        return max(0, math.ceil(math.log(self.max_interval_seconds / self.retry_interval_seconds, self.backoff)))
+
+    def observe(self, idle_gpus):
+        """
+        :param idle_gpus: 本轮扫描看到的目标显卡空闲数量，参见 autodl_client.get_region_idle_gpus
+        """
+        self.idle_gpus = idle_gpus
+
+    def next_interval(self, request_count=0):
+        """
+        :param request_count: 本轮扫描发出的请求数
+        :return: (等待秒数, 原因)
+        """
+        if not self.adaptive:
+            return self.retry_interval_seconds, "fixed interval"
+        if self.idle_gpus is None or self.last_idle_gpus is None:
+            interval, reason = self.retry_interval_seconds, "no idle stats to compare yet"
+        elif self.idle_gpus != self.last_idle_gpus:
+            self.quiet_cycles = 0
+            interval, reason = self.min_interval_seconds, "idle counts changed"
+        else:
+            self.quiet_cycles += 1
+            interval = self.retry_interval_seconds * self.backoff ** min(self.quiet_cycles, self.max_backoff_exponent)
+            reason = f"idle counts unchanged for {self.quiet_cycles} scans"
+        if self.idle_gpus is not None:
+            self.last_idle_gpus = self.idle_gpus
+            self.idle_gpus = None
+        interval = min(self.max_interval_seconds, max(self.min_interval_seconds, interval))
+        if self.request_budget_per_minute and request_count:
+            budget_interval = request_count * 60 / self.request_budget_per_minute
+            if budget_interval > interval:
+                interval = budget_interval
+                reason = f"{reason}, limited by request budget ({request_count} requests," \
+                         f" {self.request_budget_per_minute}/min)"
+        logger.debug("next scan interval: %.1fs (%s)", interval, reason)
+        return interval, reason
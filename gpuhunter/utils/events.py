@@ -0,0 +1,71 @@
+import asyncio
+import copy
+import threading
+
+
+class EventBus:
+    """
+    线程安全的事件总线。发布者调用 publish 发布事件，事件的数据同时合并到 state 中，并直接唤醒订阅者；
+    订阅者调用 wait_async 等待新版本，拿到最新的 state，晚加入的订阅者直接从当前 state 开始。
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.version = 0
+        self.state = {}
+        self.counts = {}
+        # 正在等待的订阅者：{(事件循环, asyncio.Event)}
+        self.subscribers = set()
+
+    def publish(self, event_type, changed_only=False, reset_state=False, **data):
+        """
+        :param changed_only: 为 True 时，如果 data 与 state 中的值都相同就不发布
+        :param reset_state: 为 True 时先清空 state 和事件计数，用于开始新一轮蹲守
+        :return: 是否发布了事件
+        """
+        with self.lock:
+            if changed_only and all(self.state.get(k) == v for k, v in data.items()):
+                return False
+            if reset_state:
+                self.state.clear()
+                self.counts.clear()
+            self.version += 1
+            self.counts[event_type] = self.counts.get(event_type, 0) + 1
+            self.state.update(data)
+            subscribers = list(self.subscribers)
+        # 发布者通常在蹲守线程中，通过订阅者的事件循环唤醒它
+        for loop, event in subscribers:
+            try:
+                loop.call_soon_threadsafe(event.set)
+            except RuntimeError:
+                # 事件循环已经关闭
+                pass
+        return True
+
+    def snapshot(self):
+        with self.lock:
+            return self.version, {**copy.deepcopy(self.state), "counts": dict(self.counts)}
+
+    async def wait_async(self, version=0, timeout=None):
+        """
+        等待比 version 更新的事件，由 publish 直接唤醒，等待期间不占用线程。
+        :param timeout: 超时也返回，用作保活
+        :return: (最新版本, state 的副本)
+        """
+        subscriber = (asyncio.get_running_loop(), asyncio.Event())
+        with self.lock:
+            is_new = self.version > version
+            if not is_new:
+                self.subscribers.add(subscriber)
+        if not is_new:
+            try:
+                await asyncio.wait_for(subscriber[1].wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                with self.lock:
+                    self.subscribers.discard(subscriber)
+        return self.snapshot()
+
+
+hunt_events = EventBus()
@@ -1,5 +1,10 @@
+import copy
 import datetime
+import functools
 import json
+import threading
+import time
+from collections import OrderedDict
 
 
 def json_dumps(obj, *args, **kwargs):
@@ -7,6 +12,40 @@ def json_dumps(obj, *args, **kwargs):
     return json.dumps(obj, *args, **kwargs)
 
 
+def ttl_cache(seconds, maxsize=1):
+    """
+    按参数缓存函数结果 seconds 秒，最多保留 maxsize 个不同参数的结果，调用 cache_clear() 清空。
+    """
+
+    def decorator(func):
+        cache = OrderedDict()
+        lock = threading.Lock()
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            key = json_dumps([args, kwargs], sort_keys=True, default=repr)
+            with lock:
+                entry = cache.get(key)
+            if entry and time.time() - entry[0] < seconds:
+                return copy.deepcopy(entry[1])
+            result = func(*args, **kwargs)
+            with lock:
+                cache[key] = (time.time(), result)
+                cache.move_to_end(key)
+                while len(cache) > maxsize:
+                    cache.popitem(last=False)
+            return copy.deepcopy(result)
+
+        def cache_clear():
+            with lock:
+                cache.clear()
+
+        wrapper.cache_clear = cache_clear
+        return wrapper
+
+    return decorator
+
+
 def url_set_params(url, **params):
     import urllib.parse as urlparse
     from urllib.parse import urlencode
@@ -0,0 +1,59 @@
+import os
+from collections import deque
+
+
+class LogTail:
+    """
+    增量读取日志文件：记住上次读到的字节位置，每次只读取新增的完整行，最多保留最近 max_lines 行。
+    文件被清空或轮转（inode 改变）时从头开始读取。
+    """
+
+    def __init__(self, filename, max_lines=1000, max_line_bytes=1024):
+        self.filename = filename
+        self.max_lines = max_lines
+        # 第一次打开很大的文件时，只读取末尾 max_lines * max_line_bytes 字节
+        self.max_line_bytes = max_line_bytes
+        self.lines = deque(maxlen=max_lines)
+        self.inode = None
+        self.offset = 0
+        self.partial = b""
+
+    def reset(self, inode=None):
+        self.lines.clear()
+        self.inode = inode
+        self.offset = 0
+        self.partial = b""
+
+    def update(self):
+        """
+        :return: 是否读取到了新的行
+        """
+        try:
+            stat = os.stat(self.filename)
+        except FileNotFoundError:
+            changed = self.inode is not None or len(self.lines) > 0
+            self.reset()
+            return changed
+        changed = False
+        if stat.st_ino != self.inode or stat.st_size < self.offset:
+            changed = self.inode is not None or len(self.lines) > 0
+            self.reset(stat.st_ino)
+        if stat.st_size == self.offset:
+            return changed
+        with open(self.filename, "rb") as f:
+            skip_first_line = False
+            if self.offset == 0 and stat.st_size > self.max_lines * self.max_line_bytes:
+                self.offset = stat.st_size - self.max_lines * self.max_line_bytes
+                skip_first_line = True
+            f.seek(self.offset)
+            data = f.read(stat.st_size - self.offset)
+        self.offset += len(data)
+        *lines, self.partial = (self.partial + data).split(b"\n")
+        if skip_first_line and lines:
+            lines = lines[1:]
+        self.lines.extend(line.decode("utf-8", errors="replace") for line in lines)
+        return changed or len(lines) > 0
+
+    @property
+    def text(self):
+        return "\n".join(self.lines)
@@ -1,7 +1,12 @@
+import atexit
 import logging
 import os.path
+import queue
+import random
+import reprlib
 import sys
-from logging.handlers import TimedRotatingFileHandler
+import threading
+from logging.handlers import TimedRotatingFileHandler, QueueHandler, QueueListener
 
 verbose_formatter = logging.Formatter(
     "[%(asctime)s][%(levelname)s][%(name)s][%(filename)s:%(lineno)d]%(message)s"
@@ -11,15 +16,128 @@ simple_formatter = logging.Formatter(
     datefmt="%Y-%m-%d %H:%M:%S",
 )
 
+# 调试日志中大块数据（API 返回值、机器和实例列表等）的输出方式，参见 configure_payload_logging
+payload_options = {
+    "sample_rate": 0.1,
+    "max_length": 2000,
+}
 
-def get_logger(logger_name, logs_dir):
+
+def configure_payload_logging(sample_rate=None, max_length=None):
+    """
+    :param sample_rate: 大块数据按此比例抽样输出，0 表示不输出
+    :param max_length: 每条大块数据最多输出的字符数，0 表示不截断
+    """
+    if sample_rate is not None:
+        payload_options["sample_rate"] = sample_rate
+    if max_length is not None:
+        payload_options["max_length"] = max_length
+
+
+class LazyRepr:
+    """
+    延迟到日志真正输出时才生成 repr。列表和字典只展开前几项，结果截断到 max_length 个字符，
+    避免为几 MB 的数据生成完整的 repr。
+    """
+    __slots__ = ("value", "max_length")
+
+    def __init__(self, value, max_length=None):
+        self.value = value
+        self.max_length = max_length
+
+    def __str__(self):
+        max_length = payload_options["max_length"] if self.max_length is None else self.max_length
+        if not max_length:
+            return repr(self.value)
+        short_repr = reprlib.Repr()
+        short_repr.maxlevel = 4
+        short_repr.maxlist = short_repr.maxtuple = short_repr.maxset = 10
+        short_repr.maxdict = 20
+        short_repr.maxstring = short_repr.maxother = max_length
+        text = short_repr.repr(self.value)
+        if len(text) > max_length:
+            text = text[:max_length] + "..."
+        if hasattr(self.value, "__len__") and not isinstance(self.value, str):
+            text += f" <len={len(self.value)}>"
+        return text
+
+
+def debug_payload(logger, label, value):
+    """
+    按 payload_options 抽样并截断后，在 DEBUG 级别输出一块数据。
+    """
+    sample_rate = payload_options["sample_rate"]
+    if sample_rate <= 0 or not logger.isEnabledFor(logging.DEBUG):
+        return
+    if sample_rate < 1 and random.random() >= sample_rate:
+        return
+    logger.debug("%s: %s", label, LazyRepr(value), stacklevel=2)
+
+
+class BoundedQueueHandler(QueueHandler):
+    """
+    把日志记录放入有界队列，由后台的 QueueListener 写入屏幕和文件，调用线程不做任何 I/O。
+    队列满时丢弃新的 DEBUG / INFO 日志；WARNING 及以上的日志则挤掉队列中最早的一条。
+    丢弃的条数会在队列恢复后补记一条警告。
+    """
+
+    def __init__(self, maxsize=10000):
+        super().__init__(queue.Queue(maxsize))
+        self.dropped = 0
+        self.dropped_lock = threading.Lock()
+
+    def prepare(self, record):
+        # 同一进程内的队列不需要像默认实现那样提前格式化，格式化交给后台线程
+        return record
+
+    def enqueue(self, record):
+        if dropped := self.dropped:
+            try:
+                self.queue.put_nowait(self.make_dropped_record(record, dropped))
+                with self.dropped_lock:
+                    self.dropped -= dropped
+            except queue.Full:
+                pass
+        if not self.put(record):
+            with self.dropped_lock:
+                self.dropped += 1
+
+    def put(self, record):
+        try:
+            self.queue.put_nowait(record)
+            return True
+        except queue.Full:
+            if record.levelno < logging.WARNING:
+                return False
+        try:
+            self.queue.get_nowait()
+            with self.dropped_lock:
+                self.dropped += 1
+            self.queue.put_nowait(record)
+            return True
+        except (queue.Empty, queue.Full):
+            return False
+
+    @staticmethod
+    def make_dropped_record(record, dropped):
+        return logging.LogRecord(
+            record.name, logging.WARNING, __file__, 0,
+            f"日志队列已满，丢弃了 {dropped} 条日志。 Log queue is full, {dropped} records dropped.",
+            None, None,
+        )
+
+
+def get_logger(logger_name, logs_dir, queue_size=10000):
+    """
+    屏幕和文件的写入都在后台线程中进行，进程退出时写完队列中剩余的日志。
+    """
     logger = logging.getLogger(logger_name)
     logger.setLevel(logging.DEBUG)
     # 屏幕
     stream_handler = logging.StreamHandler(sys.stdout)
     stream_handler.setLevel(logging.INFO)
     stream_handler.setFormatter(simple_formatter)
-    logger.addHandler(stream_handler)
+    output_handlers = [stream_handler]
     # 文件
     handlers = (
         (logging.DEBUG, "main.log", verbose_formatter),
@@ -33,5 +151,10 @@ def get_logger(logger_name, logs_dir):
         )
         file_handler.setLevel(level)
         file_handler.setFormatter(formatter)
-        logger.addHandler(file_handler)
+        output_handlers.append(file_handler)
+    queue_handler = BoundedQueueHandler(queue_size)
+    logger.addHandler(queue_handler)
+    listener = QueueListener(queue_handler.queue, *output_handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
     return logger
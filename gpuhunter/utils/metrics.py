@@ -0,0 +1,185 @@
+import bisect
+import json
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Histogram:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.bucket_counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        self.bucket_counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def to_dict(self):
+        cumulative = 0
+        buckets = {}
+        for bound, count in zip(list(self.buckets) + ["+Inf"], self.bucket_counts):
+            cumulative += count
+            buckets[str(bound)] = cumulative
+        return {"count": self.count, "sum": self.sum, "buckets": buckets}
+
+
+class MetricsRegistry:
+    """
+    进程内的指标：计数器、仪表和直方图，每个指标可以带标签，可以导出为 JSON 或 Prometheus 文本格式。
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.descriptions = {}
+
+    @staticmethod
+    def get_key(name, labels):
+        return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def describe(self, name, description):
+        self.descriptions[name] = description
+
+    def inc(self, name, value=1, **labels):
+        key = self.get_key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        key = self.get_key(name, labels)
+        with self.lock:
+            self.gauges[key] = value
+
+    def setdefault(self, name, value, **labels):
+        """
+        仪表不存在时才设置，返回最终的值。
+        """
+        key = self.get_key(name, labels)
+        with self.lock:
+            return self.gauges.setdefault(key, value)
+
+    def observe(self, name, value, buckets=DEFAULT_BUCKETS, **labels):
+        key = self.get_key(name, labels)
+        with self.lock:
+            if (histogram := self.histograms.get(key)) is None:
+                histogram = self.histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        started_at = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - started_at, **labels)
+
+    def get(self, name, **labels):
+        key = self.get_key(name, labels)
+        with self.lock:
+            if key in self.counters:
+                return self.counters[key]
+            if key in self.gauges:
+                return self.gauges[key]
+            if key in self.histograms:
+                return self.histograms[key].to_dict()
+        return None
+
+    def to_dict(self):
+        def group(items, convert=lambda v: v):
+            result = {}
+            for (name, labels), value in sorted(items, key=lambda i: i[0]):
+                result.setdefault(name, []).append({"labels": dict(labels), "value": convert(value)})
+            return result
+
+        with self.lock:
+            return {
+                "counters": group(self.counters.items()),
+                "gauges": group(self.gauges.items()),
+                "histograms": group(self.histograms.items(), lambda h: h.to_dict()),
+            }
+
+    def to_json(self, **kwargs):
+        kwargs.setdefault("ensure_ascii", False)
+        return json.dumps(self.to_dict(), **kwargs)
+
+    def to_prometheus(self):
+        def format_labels(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            if not pairs:
+                return ""
+            escaped = [(k, v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+                       for k, v in pairs]
+            return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+        lines = []
+        with self.lock:
+            sections = (
+                ("counter", sorted(self.counters.items())),
+                ("gauge", sorted(self.gauges.items())),
+                ("histogram", sorted(self.histograms.items(), key=lambda i: i[0])),
+            )
+            for metric_type, items in sections:
+                last_name = None
+                for (name, labels), value in items:
+                    if name != last_name:
+                        if name in self.descriptions:
+                            lines.append(f"# HELP {name} {self.descriptions[name]}")
+                        lines.append(f"# TYPE {name} {metric_type}")
+                        last_name = name
+                    if metric_type == "histogram":
+                        cumulative = 0
+                        for bound, count in zip(list(value.buckets) + ["+Inf"], value.bucket_counts):
+                            cumulative += count
+                            lines.append(f"{name}_bucket{format_labels(labels, [('le', str(bound))])} {cumulative}")
+                        lines.append(f"{name}_sum{format_labels(labels)} {value.sum}")
+                        lines.append(f"{name}_count{format_labels(labels)} {value.count}")
+                    else:
+                        lines.append(f"{name}{format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    registry = None
+
+    def do_GET(self):
+        path = self.path.split("?", 1)[0]
+        if path == "/metrics":
+            body, content_type = self.registry.to_prometheus(), "text/plain; version=0.0.4; charset=utf-8"
+        elif path == "/metrics.json":
+            body, content_type = self.registry.to_json(), "application/json; charset=utf-8"
+        else:
+            self.send_error(404)
+            return
+        body = body.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        from main import logger
+        logger.debug(f"metrics server: {self.address_string()} {format % args}")
+
+
+def start_http_server(port, host="127.0.0.1", registry=None):
+    """
+    在后台线程中启动指标服务，/metrics 为 Prometheus 文本格式，/metrics.json 为 JSON 格式。
+    :return: ThreadingHTTPServer，调用 shutdown() 停止
+    """
+    handler = type("MetricsRequestHandler", (MetricsRequestHandler,), {"registry": registry or metrics})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    return server
+
+
+metrics = MetricsRegistry()
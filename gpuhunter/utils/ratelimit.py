@@ -0,0 +1,95 @@
+import asyncio
+import heapq
+import itertools
+import threading
+import time
+
+
+class TokenBucket:
+    """
+    令牌桶限流器：每秒补充 rate 个令牌，最多积累 capacity 个。
+    等待中的调用按 priority 排队（数值越小越优先），先满足优先级高的调用，同优先级按先后顺序。
+    """
+
+    def __init__(self, rate, capacity):
+        self.check(rate, capacity)
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.condition = threading.Condition()
+        self.waiters = []
+        self.sequence = itertools.count()
+
+    @staticmethod
+    def check(rate, capacity):
+        if rate <= 0 or capacity <= 0:
+            raise ValueError(f"Rate and capacity must be positive: rate={rate!r}, capacity={capacity!r}")
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def configure(self, rate, capacity):
+        """
+        修改速率和容量，已经在排队的调用继续使用同一个队列。
+        """
+        self.check(rate, capacity)
+        with self.condition:
+            self.refill()
+            self.rate = rate
+            self.capacity = capacity
+            self.tokens = min(self.tokens, capacity)
+            self.condition.notify_all()
+
+    def acquire(self, weight=1, priority=0):
+        """
+        阻塞直到拿到 weight 个令牌。
+        :return: 等待的秒数
+        """
+        weight = min(weight, self.capacity)
+        started_at = time.monotonic()
+        with self.condition:
+            entry = (priority, next(self.sequence))
+            heapq.heappush(self.waiters, entry)
+            try:
+                while True:
+                    self.refill()
+                    is_head = self.waiters[0] == entry
+                    if is_head and self.tokens >= weight:
+                        self.tokens -= weight
+                        return time.monotonic() - started_at
+                    # 队首等待令牌补足，其它调用等待队首离开后再检查
+                    self.condition.wait((weight - self.tokens) / self.rate if is_head else None)
+            finally:
+                self.waiters.remove(entry)
+                heapq.heapify(self.waiters)
+                self.condition.notify_all()
+
+    async def acquire_async(self, weight=1, priority=0, poll_interval=0.05):
+        """
+        acquire 的 asyncio 版本，与 acquire 共用同一个队列，等待时不占用线程。
+        队首按需要补充的时间 sleep，其它调用无法被 condition 唤醒，每 poll_interval 秒检查一次。
+        :return: 等待的秒数
+        """
+        weight = min(weight, self.capacity)
+        started_at = time.monotonic()
+        with self.condition:
+            entry = (priority, next(self.sequence))
+            heapq.heappush(self.waiters, entry)
+        try:
+            while True:
+                with self.condition:
+                    self.refill()
+                    is_head = self.waiters[0] == entry
+                    if is_head and self.tokens >= weight:
+                        self.tokens -= weight
+                        return time.monotonic() - started_at
+                    delay = (weight - self.tokens) / self.rate if is_head else poll_interval
+                await asyncio.sleep(delay)
+        finally:
+            with self.condition:
+                self.waiters.remove(entry)
+                heapq.heapify(self.waiters)
+                self.condition.notify_all()
@@ -0,0 +1,128 @@
+import asyncio
+import random
+import threading
+import time
+
+from requests import RequestException
+
+from main import logger
+
+
+class CircuitOpenError(RequestException):
+    pass
+
+
+class CircuitBreaker:
+    """
+    连续失败 failure_threshold 次后断开 reset_seconds 秒，期间的调用直接失败；
+    到时间后放行一次试探调用，成功则恢复，失败则继续断开。
+    """
+
+    def __init__(self, name, failure_threshold=5, reset_seconds=30):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None and time.monotonic() - self.opened_at < self.reset_seconds
+
+    def before_call(self):
+        with self.lock:
+            if self.is_open:
+                raise CircuitOpenError(f"Circuit breaker is open for {self.name}")
+            if self.opened_at is not None:
+                # 半开状态：只放行一次试探调用
+                self.opened_at = time.monotonic()
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                if self.opened_at is None:
+                    logger.warning(f"circuit breaker opened: {self.name}, failures: {self.failures}")
+                self.opened_at = time.monotonic()
+
+
+class RetryPolicy:
+    """
+    最多尝试 tries 次，每次等待时间按 backoff 倍数增长、不超过 max_delay，并加入 jitter 比例的随机抖动；
+    整个调用（含重试）不超过 deadline 秒，单次请求的超时时间为 timeout 秒。
+    """
+
+    def __init__(self, tries=3, delay=1, max_delay=10, backoff=2, jitter=0.5, deadline=60, timeout=10):
+        self.tries = tries
+        self.delay = delay
+        self.max_delay = max_delay
+        self.backoff = backoff
+        self.jitter = jitter
+        self.deadline = deadline
+        self.timeout = timeout
+
+    def get_delay(self, attempt):
+        delay = min(self.max_delay, self.delay * self.backoff ** (attempt - 1))
+        return delay * (1 + random.uniform(-self.jitter, self.jitter))
+
+    def next_delay(self, attempt, started_at, error):
+        """
+        :return: 下次重试前需要等待的秒数，不应再重试时返回 None
+        """
+        if attempt >= self.tries or isinstance(error, CircuitOpenError):
+            return None
+        delay = self.get_delay(attempt)
+        if self.deadline is not None and time.monotonic() - started_at + delay + self.timeout > self.deadline:
+            return None
+        logger.warning(f"{error!r}, retrying in {delay:.1f} seconds...")
+        return delay
+
+    def call(self, func, circuit_breaker=None, exceptions=RequestException):
+        started_at = time.monotonic()
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                if circuit_breaker is not None:
+                    circuit_breaker.before_call()
+                result = func()
+            except exceptions as e:
+                if circuit_breaker is not None and not isinstance(e, CircuitOpenError):
+                    circuit_breaker.record_failure()
+                    if circuit_breaker.is_open:
+                        raise
+                if (delay := self.next_delay(attempt, started_at, e)) is None:
+                    raise
+                time.sleep(delay)
+            else:
+                if circuit_breaker is not None:
+                    circuit_breaker.record_success()
+                return result
+
+    async def call_async(self, func, circuit_breaker=None, exceptions=RequestException):
+        started_at = time.monotonic()
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                if circuit_breaker is not None:
+                    circuit_breaker.before_call()
+                result = await func()
+            except exceptions as e:
+                if circuit_breaker is not None and not isinstance(e, CircuitOpenError):
+                    circuit_breaker.record_failure()
+                    if circuit_breaker.is_open:
+                        raise
+                if (delay := self.next_delay(attempt, started_at, e)) is None:
+                    raise
+                await asyncio.sleep(delay)
+            else:
+                if circuit_breaker is not None:
+                    circuit_breaker.record_success()
+                return result
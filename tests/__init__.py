@@ -1,3 +1,4 @@
 from gpuhunter.utils.logging import get_logger
+from main import LOGS_DIR
 
-logger = get_logger(__name__)
+logger = get_logger(__name__, LOGS_DIR)
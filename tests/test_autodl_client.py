@@ -0,0 +1,69 @@
+import threading
+import unittest
+from unittest import mock
+
+from gpuhunter import autodl_client
+from gpuhunter.autodl_client import AutodlClient, FailedError, get_region_idle_gpus
+from gpuhunter.data_object import Config, RegionList
+from gpuhunter.utils.ratelimit import TokenBucket
+
+REGION_LIST = RegionList(list=[
+    {"region_name": "西北B区", "region_sign": "westDC2",
+     "gpu_types": [{"gpu_type": "RTX 4090", "idle_gpu_num": 1, "total_gpu_num": 100}]},
+    {"region_name": "北京A区", "region_sign": "beijingDC1",
+     "gpu_types": [{"gpu_type": "RTX 4090", "idle_gpu_num": 2, "total_gpu_num": 100}]},
+    {"region_name": "内蒙A区", "region_sign": "neimengDC1",
+     "gpu_types": [{"gpu_type": "RTX 4090", "idle_gpu_num": 3, "total_gpu_num": 100}]},
+])
+
+
+class GetRegionIdleGpusTestCase(unittest.TestCase):
+    def setUp(self):
+        self.client = mock.Mock(region_fetch_workers=2, region_fetch_timeout_seconds=0.2)
+        patcher = mock.patch.object(autodl_client, "autodl_client", self.client)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_failed_and_slow_regions_keep_last_stats(self):
+        released = threading.Event()
+        self.addCleanup(released.set)
+
+        def get_region_gpu_types(region_sign):
+            if region_sign == "westDC2":
+                return [{"RTX 4090": {"idle_gpu_num": 5}}, {"RTX 3090": {"idle_gpu_num": 7}}]
+            if region_sign == "beijingDC1":
+                raise FailedError("token invalid")
+            released.wait(5)
+            return [{"RTX 4090": {"idle_gpu_num": 9}}]
+
+        self.client.get_region_gpu_types.side_effect = get_region_gpu_types
+        idle_gpus = get_region_idle_gpus(REGION_LIST, ["西北B区", "北京A区", "内蒙A区"], ["RTX 4090"])
+        self.assertEqual(idle_gpus, {
+            "西北B区": {"RTX 4090": 5},
+            "北京A区": {"RTX 4090": 2},
+            "内蒙A区": {"RTX 4090": 3},
+        })
+
+
+class LoadConfigTestCase(unittest.TestCase):
+    def load_config(self, **kwargs):
+        client = AutodlClient(rate_limiter=TokenBucket(10, 20))
+        with mock.patch.object(Config, "load", lambda config: config.__dict__.update(kwargs) or config):
+            client.load_config()
+        return client
+
+    def test_apply_rate_limit(self):
+        client = self.load_config(token="token", rate_limit_per_second=5, rate_limit_burst=8)
+        self.assertEqual((client.token, client.rate_limiter.rate, client.rate_limiter.capacity), ("token", 5, 8))
+
+    def test_keep_rate_limit_when_invalid(self):
+        for rate_limit_per_second in (0, -1, "fast"):
+            with self.assertLogs("main", "ERROR"):
+                client = self.load_config(token="token", region_fetch_workers=4,
+                                          rate_limit_per_second=rate_limit_per_second)
+            self.assertEqual((client.rate_limiter.rate, client.rate_limiter.capacity), (10, 20))
+            self.assertEqual((client.token, client.region_fetch_workers), ("token", 4))
+
+
+if __name__ == "__main__":
+    unittest.main()
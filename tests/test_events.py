@@ -0,0 +1,48 @@
+import asyncio
+import threading
+import time
+import unittest
+
+from gpuhunter.utils.events import EventBus
+
+
+class EventBusTestCase(unittest.TestCase):
+    def test_publish_merges_state(self):
+        bus = EventBus()
+        self.assertTrue(bus.publish("scan", running=True, machines_matched=0))
+        self.assertFalse(bus.publish("scan", changed_only=True, machines_matched=0))
+        self.assertEqual(bus.snapshot(), (1, {"running": True, "machines_matched": 0, "counts": {"scan": 1}}))
+        bus.publish("hunt_started", reset_state=True, running=True)
+        self.assertEqual(bus.snapshot(), (2, {"running": True, "counts": {"hunt_started": 1}}))
+
+    def test_return_at_once_when_already_newer(self):
+        bus = EventBus()
+        bus.publish("scan", running=True)
+        version, state = asyncio.run(bus.wait_async(0, timeout=5))
+        self.assertEqual(version, 1)
+        self.assertFalse(bus.subscribers)
+
+    def test_publish_from_another_thread_wakes_subscriber(self):
+        bus = EventBus()
+
+        async def main():
+            threading.Timer(0.05, bus.publish, args=("hunt_stopped",), kwargs={"stopping": False}).start()
+            started_at = time.monotonic()
+            result = await bus.wait_async(0, timeout=5)
+            return result, time.monotonic() - started_at
+
+        (version, state), elapsed = asyncio.run(main())
+        self.assertEqual((version, state["stopping"]), (1, False))
+        self.assertLess(elapsed, 1)
+        self.assertFalse(bus.subscribers)
+
+    def test_timeout_returns_current_state(self):
+        bus = EventBus()
+        bus.publish("scan", running=True)
+        version, state = asyncio.run(bus.wait_async(1, timeout=0.05))
+        self.assertEqual((version, state["running"]), (1, True))
+        self.assertFalse(bus.subscribers)
+
+
+if __name__ == "__main__":
+    unittest.main()
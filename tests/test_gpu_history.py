@@ -0,0 +1,97 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from gpuhunter.data_object import GpuHistoryIndex
+from gpuhunter.gpu_history import RECORD, GpuHistory
+
+REGION_LIST = [{"region_name": "西北B区", "gpu_types": [{"gpu_type": "RTX 4090", "idle_gpu_num": 3,
+                                                       "total_gpu_num": 100}]}]
+
+
+class GpuHistoryTestCase(unittest.TestCase):
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        index_path = os.path.join(temp_dir.name, "gpu_history_index.json")
+        patcher = mock.patch.object(GpuHistoryIndex, "data_path", new=property(lambda _: index_path))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.history = GpuHistory(os.path.join(temp_dir.name, "gpu_history.bin"), bucket_seconds=10 ** 10)
+
+    def test_append_drops_torn_record(self):
+        self.history.append(REGION_LIST, timestamp=1700000000)
+        with open(self.history.filename, "ab") as f:
+            f.write(RECORD.pack(1700000060, 0, 1, 1, 1, 1, 100)[:5])
+        self.history.append(REGION_LIST, timestamp=1700000120)
+        self.assertEqual(os.path.getsize(self.history.filename), RECORD.size * 2)
+        self.assertEqual(
+            [r["time"] for r in self.history.query(since=1700000000)],
+            [1700000000, 1700000120],
+        )
+
+
+    def append_idle(self, timestamp, idle_gpu_num, total_gpu_num=100):
+        self.history.append([{"region_name": "西北B区", "gpu_types": [
+            {"gpu_type": "RTX 4090", "idle_gpu_num": idle_gpu_num, "total_gpu_num": total_gpu_num},
+        ]}], timestamp=timestamp)
+
+    def test_query_by_series_and_time(self):
+        self.history.append([
+            {"region_name": "西北B区", "gpu_types": [{"gpu_type": "RTX 4090", "idle_gpu_num": 3, "total_gpu_num": 100},
+                                                  {"gpu_type": "RTX 3090", "idle_gpu_num": 1, "total_gpu_num": 50}]},
+            {"region_name": "北京A区", "gpu_types": [{"gpu_type": "RTX 4090", "idle_gpu_num": 0, "total_gpu_num": 80}]},
+        ], timestamp=1700000000)
+        self.append_idle(1700000600, 5)
+        self.append_idle(1700001200, 2)
+        records = self.history.query(["西北B区"], ["RTX 4090"], since=1700000300, until=1700001200)
+        self.assertEqual(records, [{
+            "time": 1700000600,
+            "region_name": "西北B区",
+            "gpu_type": "RTX 4090",
+            "samples": 1,
+            "idle_gpu_num_max": 5,
+            "idle_gpu_num_sum": 5,
+            "available_samples": 1,
+            "total_gpu_num": 100,
+        }])
+        self.assertEqual(len(self.history.query(gpu_types=["RTX 4090"])), 4)
+
+    def test_compact_keeps_bucket_statistics(self):
+        day = 86400
+        now = 1700000000 - 1700000000 % 3600 + 40 * day
+        # 旧的一小时内 6 次采样，其中 2 次有空闲；更早的记录超过保留天数
+        self.append_idle(now - 31 * day, 9)
+        for i, idle_gpu_num in enumerate([0, 0, 6, 0, 0, 3]):
+            self.append_idle(now - 5 * day + i * 600, idle_gpu_num)
+        self.append_idle(now - 3600, 1)
+        self.history.bucket_seconds = 3600
+        self.history.compact(now=now)
+        self.assertEqual(list(self.history.read_records()), [
+            (now - 5 * day, 0, 6, 6, 9, 2, 100),
+            (now - 3600, 0, 1, 1, 1, 1, 100),
+        ])
+        # 汇总时按采样次数加权，与降采样之前的结果相同
+        aggregated = GpuHistory.aggregate(self.history.query(), bucket_seconds=day)
+        self.assertEqual([(b["samples"], b["idle_gpu_num_max"], b["idle_gpu_num_avg"], b["available_ratio"])
+                          for b in aggregated], [(6, 6, 1.5, 1 / 3), (1, 1, 1, 1)])
+
+    def test_compact_merges_into_downsampled_record(self):
+        old = 1700000000 - 1700000000 % 3600
+        self.append_idle(old, 4)
+        self.append_idle(old + 1800, 0, total_gpu_num=120)
+        self.history.bucket_seconds = 3600
+        # 第一次整理时只有第一条记录超过 raw_days
+        now = old + 900 + 2 * 86400
+        self.history.compact(now=now)
+        self.assertEqual(list(self.history.read_records()), [
+            (old, 0, 1, 4, 4, 1, 100),
+            (old + 1800, 0, 1, 0, 0, 0, 120),
+        ])
+        # 之后同一时间段的记录合并到已经降采样的记录中
+        self.history.compact(now=now + 3600)
+        self.assertEqual(list(self.history.read_records()), [(old, 0, 2, 4, 4, 1, 120)])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,103 @@
+import unittest
+from unittest import mock
+
+from gpuhunter.data_object import Config, RegionList
+from gpuhunter.hunt_engine import Hunt, MultiHuntEngine
+
+IMAGE_INFO = {
+    "image": "hub.kce.ksyun.com/autodl-image/torch:cuda11.8",
+    "private_image_uuid": "",
+    "reproduction_uuid": "",
+    "reproduction_id": 0,
+}
+
+
+def make_instance(uuid):
+    return {
+        "uuid": uuid,
+        "region_name": "西北B区",
+        "snapshot_gpu_alias_name": "RTX 4090",
+        **IMAGE_INFO,
+    }
+
+
+def make_hunt(name, priority, instance_num):
+    config = Config(
+        region_names=["西北B区"],
+        gpu_type_names=["RTX 4090"],
+        instance_num=instance_num,
+        base_image_labels=["PyTorch", "2.0.0"],
+    )
+    return Hunt(config, name=name, priority=priority)
+
+
+@mock.patch("gpuhunter.hunt_engine.resolve_image_info", return_value=IMAGE_INFO)
+class CollectDemandsTestCase(unittest.TestCase):
+    region_list = RegionList(list=[{"region_name": "西北B区", "region_sign": ["westDC2"]}])
+
+    def collect_demands(self, hunts, uuids):
+        engine = MultiHuntEngine(hunts)
+        demands, satisfied_hunts = engine.collect_demands(
+            engine.hunts, self.region_list, [make_instance(u) for u in uuids]
+        )
+        return [(h.name, n) for h, n, _, _, _ in demands], [h.name for h in satisfied_hunts]
+
+    def test_higher_priority_hunt_takes_at_most_instance_num(self, _):
+        hunts = [make_hunt("a", 1, 2), make_hunt("b", 5, 1)]
+        demands, satisfied = self.collect_demands(hunts, ["b1", "a1"])
+        self.assertEqual(demands, [("a", 1)])
+        self.assertEqual(satisfied, ["b"])
+
+    def test_finished_hunt_keeps_its_instances(self, _):
+        hunts = [make_hunt("a", 1, 1), make_hunt("b", 5, 1)]
+        hunts[1].finished = True
+        demands, satisfied = self.collect_demands(hunts, ["b1"])
+        self.assertEqual(demands, [("a", 1)])
+        self.assertEqual(satisfied, [])
+
+    def test_extra_instances_satisfy_lower_priority_hunt(self, _):
+        hunts = [make_hunt("a", 1, 1), make_hunt("b", 5, 1)]
+        demands, satisfied = self.collect_demands(hunts, ["b1", "a1", "x1"])
+        self.assertEqual(demands, [])
+        self.assertEqual(satisfied, ["b", "a"])
+
+
+@mock.patch("gpuhunter.hunt_engine.resolve_image_info", return_value=IMAGE_INFO)
+class RunCycleTestCase(unittest.TestCase):
+    region_list = RegionList(list=[{"region_name": "西北B区", "region_sign": ["westDC2"]}], fresh_list=False)
+    machine = {"machine_id": "m1", "region_sign": "westDC2", "gpu_name": "RTX 4090",
+               "gpu_idle_num": 1, "gpu_order_num": 1}
+
+    def run_cycle(self, hunt, cached_uuids, fresh_uuids):
+        instance_cache = mock.Mock()
+        instance_cache.get_instances.side_effect = lambda max_age, force=False: [
+            make_instance(u) for u in (fresh_uuids if force else cached_uuids)
+        ]
+        engine = MultiHuntEngine([hunt])
+        with mock.patch.object(RegionList, "refresh", return_value=self.region_list), \
+                mock.patch("gpuhunter.hunt_engine.instance_cache", instance_cache), \
+                mock.patch("gpuhunter.hunt_engine.get_gpu_history", return_value=None), \
+                mock.patch("gpuhunter.hunt_engine.get_available_machines", return_value=[self.machine]), \
+                mock.patch("gpuhunter.hunt_engine.create_instances", return_value=["m1"]), \
+                mock.patch("gpuhunter.hunt_engine.record_machines_matched"), \
+                mock.patch("gpuhunter.hunt_engine.after_finished"):
+            return engine.run_cycle()
+
+    def test_finish_after_created_instances_are_confirmed(self, _):
+        hunt = make_hunt("a", 0, 2)
+        self.assertTrue(self.run_cycle(hunt, ["a1"], ["a1", "a2"]))
+        self.assertTrue(hunt.finished)
+
+    def test_count_created_instance_missing_from_listing(self, _):
+        hunt = make_hunt("a", 0, 2)
+        self.assertTrue(self.run_cycle(hunt, ["a1"], ["a1"]))
+        self.assertTrue(hunt.finished)
+
+    def test_keep_hunting_when_cached_instance_was_shut_down(self, _):
+        hunt = make_hunt("a", 0, 2)
+        self.assertFalse(self.run_cycle(hunt, ["a1"], ["a2"]))
+        self.assertFalse(hunt.finished)
+
+
+if __name__ == "__main__":
+    unittest.main()
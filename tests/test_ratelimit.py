@@ -0,0 +1,92 @@
+import asyncio
+import threading
+import time
+import unittest
+
+from gpuhunter.utils.ratelimit import TokenBucket
+
+
+class TokenBucketTestCase(unittest.TestCase):
+    def test_reject_non_positive_rate(self):
+        with self.assertRaises(ValueError):
+            TokenBucket(0, 10)
+        bucket = TokenBucket(10, 20)
+        with self.assertRaises(ValueError):
+            bucket.configure(0, 20)
+        with self.assertRaises(ValueError):
+            bucket.configure(-1, 20)
+        self.assertEqual(bucket.rate, 10)
+
+    def test_acquire_without_waiting_while_tokens_last(self):
+        bucket = TokenBucket(1, 3)
+        self.assertEqual([round(bucket.acquire()) for _ in range(3)], [0, 0, 0])
+        self.assertLess(bucket.tokens, 1)
+
+    def test_weight_is_capped_at_capacity(self):
+        bucket = TokenBucket(100, 2)
+        self.assertLess(bucket.acquire(weight=5), 0.5)
+
+
+class TokenBucketPriorityTestCase(unittest.TestCase):
+    rate = 10
+
+    def setUp(self):
+        self.bucket = TokenBucket(self.rate, 1)
+        self.order = []
+        self.order_lock = threading.Lock()
+        # 取走唯一的令牌，之后的调用都要排队
+        self.bucket.acquire()
+
+    def record(self, name):
+        with self.order_lock:
+            self.order.append(name)
+
+    def start_sync_waiter(self, name, priority):
+        def run():
+            self.bucket.acquire(priority=priority)
+            self.record(name)
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        return thread
+
+    def wait_for_waiters(self, count):
+        deadline = time.monotonic() + 2
+        while len(self.bucket.waiters) < count:
+            self.assertLess(time.monotonic(), deadline, "waiters did not queue up")
+            time.sleep(0.001)
+
+    def test_sync_waiters_by_priority(self):
+        # 低优先级的先排队，高优先级的后到但先拿到令牌，同优先级按先后顺序
+        threads = [self.start_sync_waiter("low", 2)]
+        self.wait_for_waiters(1)
+        threads.append(self.start_sync_waiter("normal-1", 1))
+        self.wait_for_waiters(2)
+        threads.append(self.start_sync_waiter("normal-2", 1))
+        self.wait_for_waiters(3)
+        threads.append(self.start_sync_waiter("high", 0))
+        for thread in threads:
+            thread.join(2)
+        self.assertEqual(self.order, ["high", "normal-1", "normal-2", "low"])
+
+    def test_sync_and_async_waiters_share_the_queue(self):
+        async def run_async_waiter(name, priority):
+            await self.bucket.acquire_async(priority=priority, poll_interval=0.001)
+            self.record(name)
+
+        async def main():
+            low = asyncio.create_task(run_async_waiter("async-low", 2))
+            await asyncio.sleep(0)
+            self.wait_for_waiters(1)
+            thread = self.start_sync_waiter("sync-normal", 1)
+            self.wait_for_waiters(2)
+            high = asyncio.create_task(run_async_waiter("async-high", 0))
+            await asyncio.gather(low, high)
+            thread.join(2)
+
+        asyncio.run(main())
+        self.assertEqual(self.order, ["async-high", "sync-normal", "async-low"])
+
+
+if __name__ == "__main__":
+    unittest.main()
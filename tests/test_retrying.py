@@ -0,0 +1,125 @@
+import unittest
+from unittest import mock
+
+from requests import ConnectionError
+
+from gpuhunter.utils.retrying import CircuitBreaker, CircuitOpenError, RetryPolicy
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class ClockTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        patcher = mock.patch("gpuhunter.utils.retrying.time", self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+class CircuitBreakerTestCase(ClockTestCase):
+    def open_breaker(self):
+        breaker = CircuitBreaker("test", failure_threshold=2, reset_seconds=30)
+        breaker.record_failure()
+        self.assertFalse(breaker.is_open)
+        breaker.record_failure()
+        self.assertTrue(breaker.is_open)
+        return breaker
+
+    def test_open_breaker_rejects_calls(self):
+        breaker = self.open_breaker()
+        self.clock.now += 29
+        with self.assertRaises(CircuitOpenError):
+            breaker.before_call()
+
+    def test_half_open_allows_a_single_probe(self):
+        breaker = self.open_breaker()
+        self.clock.now += 30
+        breaker.before_call()
+        # 试探调用还没有结果时，其它调用继续被拒绝
+        with self.assertRaises(CircuitOpenError):
+            breaker.before_call()
+
+    def test_successful_probe_closes_breaker(self):
+        breaker = self.open_breaker()
+        self.clock.now += 30
+        breaker.before_call()
+        breaker.record_success()
+        self.assertFalse(breaker.is_open)
+        breaker.before_call()
+        breaker.record_failure()
+        self.assertFalse(breaker.is_open)
+
+    def test_failed_probe_reopens_breaker(self):
+        breaker = self.open_breaker()
+        self.clock.now += 30
+        breaker.before_call()
+        breaker.record_failure()
+        self.assertTrue(breaker.is_open)
+        self.clock.now += 29
+        with self.assertRaises(CircuitOpenError):
+            breaker.before_call()
+
+
+class RetryPolicyTestCase(ClockTestCase):
+    def failing_func(self, failures):
+        calls = []
+
+        def func():
+            calls.append(self.clock.now)
+            if len(calls) <= failures:
+                raise ConnectionError("connection refused")
+            return "ok"
+
+        return func, calls
+
+    def test_retry_until_success(self):
+        policy = RetryPolicy(tries=3, delay=1, backoff=2, jitter=0, deadline=None)
+        func, calls = self.failing_func(2)
+        self.assertEqual(policy.call(func), "ok")
+        self.assertEqual(self.clock.sleeps, [1, 2])
+
+    def test_give_up_after_tries(self):
+        policy = RetryPolicy(tries=3, delay=1, jitter=0, deadline=None)
+        func, calls = self.failing_func(3)
+        with self.assertRaises(ConnectionError):
+            policy.call(func)
+        self.assertEqual(len(calls), 3)
+
+    def test_no_retry_past_deadline(self):
+        # 第二次重试等待 2 秒后再加上 10 秒的请求超时，会超过 12 秒的期限
+        policy = RetryPolicy(tries=5, delay=1, backoff=2, jitter=0, deadline=12, timeout=10)
+        func, calls = self.failing_func(5)
+        with self.assertRaises(ConnectionError):
+            policy.call(func)
+        self.assertEqual(self.clock.sleeps, [1])
+        self.assertEqual(len(calls), 2)
+
+    def test_delay_is_capped_at_max_delay(self):
+        policy = RetryPolicy(delay=1, max_delay=10, backoff=2, jitter=0)
+        self.assertEqual([policy.get_delay(a) for a in (1, 4, 5, 50)], [1, 8, 10, 10])
+
+    def test_open_breaker_stops_retrying(self):
+        policy = RetryPolicy(tries=5, delay=1, jitter=0, deadline=None)
+        breaker = CircuitBreaker("test", failure_threshold=2, reset_seconds=30)
+        func, calls = self.failing_func(5)
+        with self.assertRaises(ConnectionError):
+            policy.call(func, circuit_breaker=breaker)
+        self.assertEqual(len(calls), 2)
+        with self.assertRaises(CircuitOpenError):
+            policy.call(func, circuit_breaker=breaker)
+        self.assertEqual(len(calls), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,73 @@
+import unittest
+from unittest import mock
+
+from gpuhunter import autodl_client
+from gpuhunter.commands.wait import try_to_create_instances
+from gpuhunter.data_object import Config, RegionList
+
+IMAGE_INFO = {
+    "image": "hub.kce.ksyun.com/autodl-image/torch:cuda11.8",
+    "private_image_uuid": "",
+    "reproduction_uuid": "",
+    "reproduction_id": 0,
+}
+MACHINE = {
+    "machine_id": "m1", "machine_alias": "001机", "region_sign": "westDC2", "region_name": "西北B区",
+    "gpu_name": "RTX 4090", "gpu_idle_num": 1, "gpu_order_num": 1,
+}
+
+
+def make_instance(uuid):
+    return {"uuid": uuid, "region_name": "西北B区", "snapshot_gpu_alias_name": "RTX 4090", **IMAGE_INFO}
+
+
+class TryToCreateInstancesTestCase(unittest.TestCase):
+    def setUp(self):
+        config = Config(
+            region_names=["西北B区"],
+            gpu_type_names=["RTX 4090"],
+            instance_num=2,
+            base_image_labels=["PyTorch", "2.0.0"],
+            shutdown_instance_today=False,
+            gpu_history_enabled=False,
+            mail_notify=False,
+        )
+        region_list = RegionList(list=[{"region_name": "西北B区", "region_sign": ["westDC2"]}], fresh_list=False)
+        self.client = mock.Mock()
+        self.client.create_instance.side_effect = \
+            lambda *args, **kwargs: f"new-{self.client.create_instance.call_count}"
+        self.listed_uuids = []
+        self.client.list_instance.side_effect = lambda statuses: [make_instance(u) for u in self.listed_uuids]
+        patchers = [
+            mock.patch.object(Config, "load", return_value=config),
+            mock.patch.object(RegionList, "refresh", return_value=region_list),
+            mock.patch.object(autodl_client, "autodl_client", self.client),
+            mock.patch.object(autodl_client, "instance_cache", autodl_client.InstanceCache()),
+            mock.patch.object(autodl_client, "resolve_image_info", return_value=IMAGE_INFO),
+            mock.patch.object(autodl_client, "get_available_machines", return_value=[MACHINE]),
+            mock.patch("gpuhunter.commands.wait.after_finished"),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_count_created_instance_missing_from_listing(self):
+        # 实例列表还没有包含刚创建的实例，完成前的确认不应该把它漏掉
+        self.listed_uuids = ["a1"]
+        results = [try_to_create_instances(), try_to_create_instances()]
+        self.assertEqual(results, [True, True])
+        self.assertEqual(self.client.create_instance.call_count, 1)
+
+    def test_keep_hunting_when_counted_instance_was_shut_down(self):
+        self.listed_uuids = ["a1"]
+        autodl_client.instance_cache.get_instances()
+        self.listed_uuids = []
+        self.assertFalse(try_to_create_instances())
+        self.assertEqual(self.client.create_instance.call_count, 1)
+        # 下一轮仍然计入上一轮创建、但还不在实例列表中的实例，只再创建一个
+        self.assertTrue(try_to_create_instances())
+        self.assertEqual(self.client.create_instance.call_count, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()